@@ -16,14 +16,103 @@ logger = logging.getLogger(__name__)
     default="info",
     type=click.Choice(["info", "debug", "warn"]),
 )
-def cli(log_level):
+@click.option(
+    "--http-cache-dir",
+    envvar="HTTP_CACHE_DIR",
+    help="directory for cached zoom/banner api responses; "
+    "defaults to $HTTP_CACHE_DIR",
+)
+@click.option(
+    "--http-cache-mode",
+    envvar="HTTP_CACHE_MODE",
+    default="off",
+    type=click.Choice(["off", "record", "replay"]),
+    help="'record' reuses cached responses and caches new ones; "
+    "'replay' makes no api calls at all",
+)
+@click.option(
+    "--es-pool-size",
+    envvar="ES_POOL_SIZE",
+    default=10,
+    help="max connections kept open to each elasticsearch node",
+)
+@click.option(
+    "--es-compress/--no-es-compress",
+    envvar="ES_COMPRESS",
+    default=True,
+    help="gzip larger elasticsearch request bodies, e.g. bulk requests",
+)
+@click.option(
+    "--es-max-retries",
+    envvar="ES_MAX_RETRIES",
+    default=3,
+    help="retries, with backoff, of failed or timed out elasticsearch "
+    "requests",
+)
+@click.option(
+    "--es-bulk-chunk-size",
+    envvar="ES_BULK_CHUNK_SIZE",
+    default=500,
+    help="max documents per elasticsearch bulk request",
+)
+@click.option(
+    "--es-bulk-max-bytes",
+    envvar="ES_BULK_MAX_BYTES",
+    default=10 * 1024 * 1024,
+    help="max uncompressed bytes per elasticsearch bulk request",
+)
+@click.option(
+    "--profile",
+    type=click.Choice(["cprofile", "sampling", "memory"]),
+    help="profile the command: 'cprofile' traces every call on the main "
+    "thread, 'sampling' samples the stacks of all threads and 'memory' "
+    "reports peak allocations by call site",
+)
+@click.option(
+    "--profile-out",
+    help="file to write the profile to; defaults to harvest.prof, "
+    "harvest.stacks or harvest.tracemalloc",
+)
+@click.option(
+    "--profile-top",
+    default=20,
+    help="number of entries in the logged profile summary",
+)
+@click.pass_context
+def cli(
+    ctx,
+    log_level,
+    http_cache_dir,
+    http_cache_mode,
+    es_pool_size,
+    es_compress,
+    es_max_retries,
+    es_bulk_chunk_size,
+    es_bulk_max_bytes,
+    profile,
+    profile_out,
+    profile_top,
+):
     logger.setLevel(getattr(logging, log_level.upper()))
     # turn off noisy warnings from elasticsearch/urllib3
     logging.getLogger("elasticsearch").setLevel(logging.ERROR)
+    client.configure(http_cache_dir, http_cache_mode)
+    elastic.configure(
+        pool_size=es_pool_size,
+        compress=es_compress,
+        max_retries=es_max_retries,
+        bulk_chunk_size=es_bulk_chunk_size,
+        bulk_max_bytes=es_bulk_max_bytes,
+    )
+    if profile is not None:
+        profiler = profiling.start_profiler(profile, profile_out, profile_top)
+        ctx.call_on_close(profiler.stop)
 
 
+from . import client, elastic, profiling
 from .zoom import zoom
 from .setup import setup
 from .dev import dev
 from .ocua import useractions, load_episodes
 from .export import export
+from .rollup import rollup
@@ -0,0 +1,148 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .utils import read_json_file, write_json_file
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# params that identify the caller rather than the request; they are left out
+# of response cache keys so cached responses survive credential changes
+CACHE_KEY_IGNORE_PARAMS = ("api_key", "api_secret")
+
+CACHE_MODES = ("off", "record", "replay")
+
+_session = None
+_session_lock = threading.Lock()
+_response_cache = None
+
+
+class CacheMissError(Exception):
+    pass
+
+
+def get_session(pool_size=10, retries=3, backoff=1):
+    """
+    Returns the process-wide `requests.Session`. Connections are kept alive
+    and pooled per host; failed requests and retryable status codes are
+    retried with exponential backoff.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(
+                total=retries,
+                backoff_factor=backoff,
+                status_forcelist=RETRY_STATUSES,
+                # the zoom v1 api does all of its reads via POST
+                allowed_methods=frozenset(["GET", "POST"]),
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=pool_size,
+                pool_maxsize=pool_size,
+                max_retries=retry,
+            )
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+        return _session
+
+
+class ResponseCache(object):
+    """
+    On-disk cache of decoded json responses keyed by method, url and params.
+
+    In "record" mode cached responses are returned when present and new
+    responses are written to the cache. In "replay" mode only cached
+    responses are returned and a miss raises `CacheMissError`. Error
+    responses are never cached.
+    """
+
+    def __init__(self, cache_dir, mode="record"):
+        if mode not in ("record", "replay"):
+            raise ValueError("Invalid response cache mode: %s" % mode)
+        self.cache_dir = cache_dir
+        self.mode = mode
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, method, url, params=None):
+        params = dict(
+            (k, v)
+            for k, v in (params or {}).items()
+            if k not in CACHE_KEY_IGNORE_PARAMS
+        )
+        raw = json.dumps([method.upper(), url, params], sort_keys=True)
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".json")
+
+    def get(self, key):
+        return read_json_file(self.path(key))
+
+    def set(self, key, data):
+        write_json_file(self.path(key), data)
+
+
+def configure(cache_dir=None, cache_mode="off"):
+    global _response_cache
+    if cache_mode == "off" or cache_dir is None:
+        if cache_mode != "off":
+            logger.warning("No response cache dir set; caching disabled")
+        _response_cache = None
+    else:
+        _response_cache = ResponseCache(cache_dir, cache_mode)
+        logger.info("Response cache %s in %s", cache_mode, cache_dir)
+
+
+def request_json(
+    method, url, params=None, data=None, timeout=30, rate_limiter=None
+):
+    """
+    Makes a request via the shared session and returns the decoded json
+    response, going through the response cache if one is configured.
+    `rate_limiter` is only waited on when a request actually goes out.
+    """
+    cache = _response_cache
+    if cache is not None:
+        key = cache.key(method, url, params or data)
+        cached = cache.get(key)
+        # error payloads recorded before they were excluded are misses
+        if cached is not None and not is_error_response(cached):
+            logger.debug("response cache hit for %s", url)
+            return cached
+        if cache.mode == "replay":
+            raise CacheMissError(
+                "No cached response for %s %s" % (method.upper(), url)
+            )
+
+    if rate_limiter is not None:
+        rate_limiter.wait()
+
+    resp = get_session().request(
+        method, url, params=params, data=data, timeout=timeout
+    )
+    resp.raise_for_status()
+    resp_data = resp.json()
+
+    if cache is not None and not is_error_response(resp_data):
+        cache.set(key, resp_data)
+
+    return resp_data
+
+
+def is_error_response(data):
+    """
+    The zoom api reports errors, including rate limiting and bad
+    credentials, as a 200 response with an "error" object
+    """
+    return isinstance(data, dict) and "error" in data
@@ -1,11 +1,27 @@
+import os
+import csv
+import json
+import time
 import click
+import random
+import timeit
+import logging
+import threading
+import multiprocessing
 from time import sleep
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timedelta
 from subprocess import call
+from tempfile import TemporaryDirectory
 from os.path import join, dirname
 
 from harvest_cli import cli
 from .setup import load_index_templates
 from .utils import es_connection
+from .zoom import session_duration, _session_duration
+from .zoom import to_seconds, _to_seconds
+from .ocua import iter_user_actions, has_ijson, LEAN_ACTION_FIELDS
+from .export import attendance, viewing_options, export_all
 
 BASE_PATH = dirname(dirname(__file__))
 DOCKER_PATH = join(BASE_PATH, "docker")
@@ -27,7 +43,7 @@ def init(ctx, es_host):
     retries = 10
     while True:
         try:
-            es_connection(es_host)
+            es_connection(es_host, check=True)
             break
         except Exception:
             if retries > 0:
@@ -85,3 +101,320 @@ def down(compose_file):
     click.echo("Running docker-compose down")
     cmdline = ["docker-compose", "-f", compose_file, "down"]
     call(cmdline)
+
+
+@dev.command()
+@click.option(
+    "--fixture",
+    type=click.File("r"),
+    help="json array or json lines of zoom meeting/participant records; "
+    "defaults to generated records",
+)
+@click.option("--count", default=20000, help="number of generated records")
+@click.option("--repeat", default=5, help="timing repetitions")
+def bench_zoom_parsing(fixture, count, repeat):
+    """
+    Compare the fast path zoom timestamp/duration parsers against the
+    original arrow/strptime implementations.
+    """
+    if fixture is not None:
+        text = fixture.read().strip()
+        if text.startswith("["):
+            records = json.loads(text)
+        else:
+            records = [json.loads(x) for x in text.splitlines() if x.strip()]
+    else:
+        records = generate_zoom_records(count)
+
+    sessions = [
+        (x["join_time"], x["leave_time"])
+        for x in records
+        if "join_time" in x and "leave_time" in x
+    ]
+    durations = [x["duration"] for x in records if "duration" in x]
+
+    # the fallback paths log a warning per bad input
+    logging.getLogger("harvest_cli.zoom").setLevel(logging.ERROR)
+
+    benchmarks = [
+        (
+            "session duration",
+            sessions,
+            lambda args: session_duration(*args),
+            lambda args: _session_duration(*args),
+        ),
+        ("to_seconds", durations, to_seconds, _to_seconds),
+    ]
+
+    for name, inputs, fast, original in benchmarks:
+        if len(inputs) == 0:
+            click.echo("%s: no inputs" % name)
+            continue
+
+        for value in inputs:
+            expected = _outcome(original, value)
+            actual = _outcome(fast, value)
+            if actual != expected:
+                raise click.ClickException(
+                    "%s mismatch for %r: %r != %r"
+                    % (name, value, actual, expected)
+                )
+
+        original_time = min(
+            timeit.repeat(
+                lambda: [_outcome(original, x) for x in inputs],
+                number=1,
+                repeat=repeat,
+            )
+        )
+        fast_time = min(
+            timeit.repeat(
+                lambda: [_outcome(fast, x) for x in inputs],
+                number=1,
+                repeat=repeat,
+            )
+        )
+        click.echo(
+            "%s: %d inputs, identical output; original %.3fs, fast %.3fs "
+            "(%.1fx)"
+            % (
+                name,
+                len(inputs),
+                original_time,
+                fast_time,
+                original_time / fast_time,
+            )
+        )
+
+
+def _outcome(func, value):
+    try:
+        return func(value)
+    except Exception as e:
+        return type(e)
+
+
+def generate_zoom_records(count):
+    rand = random.Random(0)
+    base = datetime(2017, 9, 1)
+    records = []
+    for i in range(count):
+        join = base + timedelta(seconds=rand.randint(0, 120 * 86400))
+        leave = join + timedelta(seconds=rand.randint(0, 4 * 3600))
+        records.append(
+            {
+                "join_time": join.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "leave_time": leave.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "duration": (
+                    str(leave - join)
+                    if i % 2
+                    else "%d:%02d" % divmod(rand.randint(0, 3599), 60)
+                ),
+            }
+        )
+
+    # inputs that have to take the fallback paths
+    records += [
+        {"join_time": "2017-09-01T10:00:00+00:00", "leave_time": None},
+        {
+            "join_time": "2017-09-01T10:00:00.123Z",
+            "leave_time": "2017-09-01T11:00:00Z",
+        },
+        {"join_time": "", "leave_time": "2017-09-01T11:00:00Z"},
+        {"duration": "1:75"},
+        {"duration": "25:00:00"},
+        {"duration": "1h 30m"},
+        {"duration": "bogus"},
+    ]
+    return records
+
+
+@dev.command()
+@click.option("--es-host", envvar="ES_HOST")
+@click.option("--term", required=True)
+@click.option("--year", required=True)
+@click.option("--chunk-interval", type=int, default=300)
+@click.option("--live/--no-live", default=False)
+@click.pass_context
+def check_export_all(ctx, es_host, term, year, chunk_interval, live):
+    """
+    Compare the attendance and viewing_options rows written by
+    `export all` against the standalone export commands.
+    """
+    with TemporaryDirectory() as tmp:
+        ctx.invoke(
+            export_all,
+            es_host=es_host,
+            term=term,
+            year=year,
+            reports="viewing_options,attendance",
+            output_dir=tmp,
+            chunk_interval=chunk_interval,
+            live=live,
+        )
+        standalone = [
+            ("attendance", attendance, {"chunk_interval": chunk_interval}),
+            ("viewing_options", viewing_options, {}),
+        ]
+        for report, command, kwargs in standalone:
+            output = join(tmp, "%s.standalone.csv" % report)
+            if report == "attendance":
+                kwargs["live"] = live
+            ctx.invoke(
+                command,
+                es_host=es_host,
+                term=term,
+                year=year,
+                output=output,
+                **kwargs
+            )
+            expected = _csv_rows(output)
+            actual = _csv_rows(join(tmp, "%s.csv" % report))
+            for i, (row, other) in enumerate(zip(actual, expected)):
+                if row != other:
+                    raise click.ClickException(
+                        "%s row %d differs: export all %r, standalone %r"
+                        % (report, i + 1, row, other)
+                    )
+            if len(actual) != len(expected):
+                raise click.ClickException(
+                    "%s: export all wrote %d rows, standalone %d"
+                    % (report, len(actual), len(expected))
+                )
+            click.echo("%s: %d identical rows" % (report, len(actual)))
+
+
+def _csv_rows(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, newline="") as f:
+        return list(csv.DictReader(f))
+
+
+@dev.command()
+@click.option("--count", default=10000, help="number of actions in the page")
+def bench_useractions_memory(count):
+    """
+    Compare the peak RSS and time of decoding a page of useractions with
+    pyhorn and with `useractions --stream-actions`.
+    """
+    if not has_ijson():
+        click.echo("ijson is not installed; the stream path decodes whole")
+
+    body = json.dumps(
+        {"actions": {"action": generate_useractions(count), "total": count}}
+    ).encode("utf-8")
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = "http://127.0.0.1:%d" % server.server_port
+    click.echo("page of %d actions, %.1f MiB" % (count, len(body) / 2.0**20))
+
+    # each path runs in a fresh process so their peak RSS can't overlap
+    context = multiprocessing.get_context("spawn")
+    try:
+        for mode in ("pyhorn", "stream"):
+            with context.Pool(1) as pool:
+                decoded, elapsed, peak_kib = pool.apply(
+                    _decode_useractions, (mode, base_url, count)
+                )
+            click.echo(
+                "%s: %d actions in %.2fs, peak RSS +%.1f MiB"
+                % (mode, decoded, elapsed, peak_kib / 1024.0)
+            )
+    finally:
+        server.shutdown()
+
+
+def _decode_useractions(mode, base_url, count):
+    import pyhorn
+
+    mh = pyhorn.MHClient(base_url, timeout=30, cache_enabled=False)
+    baseline = _reset_peak_rss()
+    start = time.time()
+    if mode == "pyhorn":
+        actions = mh.user_actions(limit=count, offset=0)
+    else:
+        actions = iter_user_actions(mh, limit=count, offset=0)
+    decoded = 0
+    for action in actions:
+        for field in LEAN_ACTION_FIELDS:
+            getattr(action, field)
+        decoded += 1
+    elapsed = time.time() - start
+    return decoded, elapsed, _peak_rss() - baseline
+
+
+def _reset_peak_rss():
+    """
+    Resets the peak RSS where linux allows it and returns the current
+    RSS in KiB; otherwise the peak so far
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return _proc_status_kib("VmRSS")
+    except (OSError, KeyError):
+        return _peak_rss()
+
+
+def _peak_rss():
+    try:
+        return _proc_status_kib("VmHWM")
+    except (OSError, KeyError):
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _proc_status_kib(key):
+    with open("/proc/self/status") as f:
+        status = dict(line.split(":", 1) for line in f)
+    return int(status[key].split()[0])
+
+
+def generate_useractions(count):
+    rand = random.Random(0)
+    base = datetime(2017, 9, 1)
+    mpids = ["%08x-0000-4000-8000-%012x" % (i, i) for i in range(50)]
+    actions = []
+    for i in range(count):
+        created = base + timedelta(seconds=i)
+        inpoint = rand.randint(0, 5400)
+        actions.append(
+            {
+                "id": 1000000 + i,
+                "created": created.strftime("%Y-%m-%dT%H:%M:%S-04:00"),
+                "mediapackageId": rand.choice(mpids),
+                "sessionId": {
+                    "sessionId": "%032x" % rand.getrandbits(128),
+                    "userId": "%08d" % rand.randint(0, 99999999),
+                    "userAgent": "Mozilla/5.0 (Macintosh; Intel Mac OS X "
+                    "10_12_6) AppleWebKit/537.36 (KHTML, like Gecko) "
+                    "Chrome/61.0.3163.100 Safari/537.36",
+                    "userIp": "10.%d.%d.%d, 172.16.0.1"
+                    % (
+                        rand.randint(0, 255),
+                        rand.randint(0, 255),
+                        rand.randint(0, 255),
+                    ),
+                },
+                "type": "HEARTBEAT",
+                "inpoint": inpoint,
+                "outpoint": inpoint + 30,
+                "length": 30,
+                "isPlaying": True,
+            }
+        )
+    return actions
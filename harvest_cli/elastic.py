@@ -0,0 +1,171 @@
+import gzip
+import time
+import logging
+import threading
+from elasticsearch import Elasticsearch
+from elasticsearch.connection import Urllib3HttpConnection
+from elasticsearch.exceptions import ConnectionError, TransportError
+from elasticsearch.helpers import bulk
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 30
+DEFAULT_POOL_SIZE = 10
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+DEFAULT_BULK_CHUNK_SIZE = 500
+DEFAULT_BULK_MAX_BYTES = 10 * 1024 * 1024
+
+RETRY_STATUSES = (429, 502, 503, 504)
+
+# request bodies smaller than this aren't worth compressing
+COMPRESS_MIN_BYTES = 1024
+
+_settings = {
+    "pool_size": DEFAULT_POOL_SIZE,
+    "compress": True,
+    "max_retries": DEFAULT_MAX_RETRIES,
+    "bulk_chunk_size": DEFAULT_BULK_CHUNK_SIZE,
+    "bulk_max_bytes": DEFAULT_BULK_MAX_BYTES,
+}
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def configure(
+    pool_size=DEFAULT_POOL_SIZE,
+    compress=True,
+    max_retries=DEFAULT_MAX_RETRIES,
+    bulk_chunk_size=DEFAULT_BULK_CHUNK_SIZE,
+    bulk_max_bytes=DEFAULT_BULK_MAX_BYTES,
+):
+    with _clients_lock:
+        _settings.update(
+            pool_size=pool_size,
+            compress=compress,
+            max_retries=max_retries,
+            bulk_chunk_size=bulk_chunk_size,
+            bulk_max_bytes=bulk_max_bytes,
+        )
+        # clients created with the old settings are left to their owners
+        _clients.clear()
+
+
+def get_client(es_host=None, **kwargs):
+    """
+    Returns the process-wide client for `es_host`, creating it on first
+    use. No request is made until the client is used; see
+    `check_connection`.
+    """
+    key = (es_host, tuple(sorted(kwargs.items())))
+    with _clients_lock:
+        if key not in _clients:
+            params = {
+                "timeout": DEFAULT_TIMEOUT,
+                "connection_class": HarvestConnection,
+                "maxsize": _settings["pool_size"],
+                "gzip_requests": _settings["compress"],
+                "request_retries": _settings["max_retries"],
+                # retries, with backoff, are done by the connection
+                "max_retries": 0,
+            }
+            if es_host is not None:
+                params["hosts"] = [es_host]
+            params.update(kwargs)
+            _clients[key] = Elasticsearch(**params)
+        return _clients[key]
+
+
+def check_connection(es):
+    try:
+        es.info()
+    except Exception as ex:
+        logger.error("Connection to elasticsearch failed: %s", ex)
+        raise
+
+
+def bulk_index(es, actions, chunk_size=None, max_chunk_bytes=None, **kwargs):
+    """
+    `elasticsearch.helpers.bulk` with the configured chunk size and max
+    chunk bytes as defaults
+    """
+    if chunk_size is None:
+        chunk_size = _settings["bulk_chunk_size"]
+    if max_chunk_bytes is None:
+        max_chunk_bytes = _settings["bulk_max_bytes"]
+    return bulk(
+        es,
+        actions,
+        chunk_size=chunk_size,
+        max_chunk_bytes=max_chunk_bytes,
+        **kwargs
+    )
+
+
+class HarvestConnection(Urllib3HttpConnection):
+    """
+    Retries connection errors, timeouts and retryable status codes with
+    exponential backoff, and optionally gzips larger request bodies
+    """
+
+    def __init__(
+        self,
+        gzip_requests=False,
+        request_retries=DEFAULT_MAX_RETRIES,
+        retry_backoff=DEFAULT_BACKOFF,
+        **kwargs
+    ):
+        super().__init__(**kwargs)
+        self.request_retries = request_retries
+        self.retry_backoff = retry_backoff
+        if gzip_requests:
+            self.pool = GzipPool(self.pool)
+
+    def perform_request(
+        self, method, url, params=None, body=None, timeout=None, ignore=()
+    ):
+        attempt = 0
+        while True:
+            try:
+                return super().perform_request(
+                    method, url, params, body, timeout, ignore
+                )
+            except TransportError as e:
+                retryable = (
+                    isinstance(e, ConnectionError)
+                    or e.status_code in RETRY_STATUSES
+                )
+                if not retryable or attempt >= self.request_retries:
+                    raise
+                delay = self.retry_backoff * 2**attempt
+                logger.warning(
+                    "%s %s failed (%s); retrying in %.1fs",
+                    method,
+                    url,
+                    e.status_code,
+                    delay,
+                )
+                time.sleep(delay)
+                attempt += 1
+
+
+class GzipPool(object):
+    """
+    Wraps a urllib3 connection pool, compressing request bodies of at
+    least `min_bytes`
+    """
+
+    def __init__(self, pool, min_bytes=COMPRESS_MIN_BYTES):
+        self.pool = pool
+        self.min_bytes = min_bytes
+
+    def urlopen(self, method, url, body=None, headers=None, **kwargs):
+        if body is not None and len(body) >= self.min_bytes:
+            if isinstance(body, str):
+                body = body.encode("utf-8")
+            body = gzip.compress(body, compresslevel=1)
+            headers = dict(headers or {}, **{"content-encoding": "gzip"})
+        return self.pool.urlopen(method, url, body, headers=headers, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.pool, name)
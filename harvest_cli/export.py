@@ -1,12 +1,12 @@
-import sys
+import os
+import time
 import click
 import logging
-import requests
 import itertools
-from time import sleep
 from math import ceil
-from csv import DictWriter
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urljoin
+from elasticsearch.helpers import scan
 from elasticsearch_dsl import Search, Q
 
 import urllib3
@@ -14,73 +14,159 @@ import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 from harvest_cli import cli
-from .utils import es_connection, get_episodes_for_term, get_series_for_term
+from . import client
+from .writers import output_options, open_writer, FORMATS
+from .rollup import rollup_viewing_options, rollup_attendance
+from .utils import (
+    es_connection,
+    configure_episode_cache,
+    get_episodes_for_term,
+    get_series_for_term,
+    chunks,
+    msearch,
+    heartbeat_span_buckets,
+    RateLimiter,
+    read_json_file,
+    write_json_file,
+    PAELLA_EVENT_FILTERS,
+)
 
 logger = logging.getLogger(__name__)
 
+# number of episodes whose rollups are read per scan
+ROLLUP_BATCH_SIZE = 100
+
+# rosters rarely change within a day
+ROSTER_CACHE_TTL = 24 * 60 * 60
+
+REPORTS = ["viewing_options", "attendance", "rollcall"]
+
+VIEWING_OPTIONS_COLUMNS = [
+    ("mpid", "category"),
+    ("huid", "category"),
+    ("captions", "int32"),
+    ("playback_speed", "int32"),
+    ("view_mode", "int32"),
+]
+
+ROLLCALL_COLUMNS = [
+    ("series", "category"),
+    ("huid", "category"),
+    ("status", "category"),
+    ("first_name", "string"),
+    ("mi", "string"),
+    ("last_name", "string"),
+    ("reg_level", "category"),
+]
+
 
 @cli.group()
-def export():
-    pass
+@click.option(
+    "--episode-cache",
+    envvar="EPISODE_LIST_CACHE_DIR",
+    help="directory to cache term episode lists in; entries are reused "
+    "until the episodes index changes",
+)
+def export(episode_cache):
+    configure_episode_cache(episode_cache)
 
 
 @export.command()
 @click.option("--es_host", envvar="ES_HOST")
 @click.option("--term")
 @click.option("--year")
-def viewing_options(es_host, term, year):
+@click.option(
+    "--batch-size",
+    default=50,
+    help="number of episode searches sent per msearch request",
+)
+@click.option(
+    "--concurrency",
+    default=4,
+    help="max number of msearch requests in flight",
+)
+@click.option(
+    "--source",
+    type=click.Choice(["useractions", "rollups"]),
+    default="useractions",
+    help="compute from raw useractions or from the rollups maintained "
+    "by the rollup command",
+)
+@output_options
+def viewing_options(
+    es_host, term, year, batch_size, concurrency, source, fmt, output
+):
     es = es_connection(es_host)
     mps = get_episodes_for_term(es, term, year, fields=["mpid"])
 
     event_aggs = {
         "aggs": {
             "huid": {
-                "terms": {"size": 100, "field": "huid"},
+                # size 0 returns every huid bucket; large lecture courses
+                # easily have more than any fixed size
+                "terms": {"size": 0, "field": "huid"},
                 "aggs": {
                     "paella_events": {
-                        "filters": {
-                            "filters": {
-                                "view_mode": {
-                                    "term": {
-                                        "action.type": "paella:button:action;edu.harvard.dce.paella.viewModeTogglePlugin"
-                                    }
-                                },
-                                "playback_speed": {
-                                    "term": {
-                                        "action.type": "paella:button:action;es.upv.paella.playbackRatePlugin"
-                                    }
-                                },
-                                "captions": {
-                                    "wildcard": {
-                                        "action.type": "paella:caption:enabled*"
-                                    }
-                                },
-                            }
-                        }
+                        "filters": {"filters": PAELLA_EVENT_FILTERS}
                     }
                 },
             }
         }
     }
 
-    writer = DictWriter(
-        sys.stdout,
-        fieldnames=["mpid", "huid", "captions", "playback_speed", "view_mode"],
-    )
-    writer.writeheader()
+    writer = open_writer(fmt, output, VIEWING_OPTIONS_COLUMNS)
+
+    if source == "rollups":
+        for batch in chunks(mps, ROLLUP_BATCH_SIZE):
+            counts = rollup_viewing_options(es, [mp.mpid for mp in batch])
+            for mp in batch:
+                for huid, row in sorted(counts[mp.mpid].items()):
+                    writer.writerow(dict(row, mpid=mp.mpid, huid=huid))
+        writer.close()
+        return
+
+    def search_batch(batch):
+        searches = []
+        for mp in batch:
+            s = Search().extra(size=0)
+            s = s.filter(
+                Q("term", mpid=mp.mpid) & ~Q("term", huid="anonymous")
+            )
+            s.update_from_dict(event_aggs)
+            searches.append(s.to_dict())
+        return msearch(es, "useractions-*", searches)
+
+    batches = list(chunks(mps, batch_size))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # map yields results in batch order, so rows come out in episode
+        # order while later batches are still being searched
+        for batch, responses in zip(
+            batches, executor.map(search_batch, batches)
+        ):
+            for mp, res in zip(batch, responses):
+                write_viewing_options_rows(writer, mp, res)
+
+    writer.close()
+
+
+# the reports would silently be missing the episode's rows
+def check_search_response(mp, res):
+    if "error" in res:
+        raise click.ClickException(
+            "Search failed for mpid %s: %s" % (mp.mpid, res["error"])
+        )
 
-    for mp in mps:
-        s = Search(using=es, index="useractions-*").extra(size=0)
-        s = s.filter(Q("term", mpid=mp.mpid) & ~Q("term", huid="anonymous"))
-        s.update_from_dict(event_aggs)
-        res = s.execute().to_dict()
-        for huid_bucket in res["aggregations"]["huid"]["buckets"]:
-            huid = huid_bucket["key"]
-            row = {"mpid": mp.mpid, "huid": huid}
-            event_buckets = huid_bucket["paella_events"]["buckets"]
-            for event_type, stats in event_buckets.items():
-                row[event_type] = stats["doc_count"]
-            writer.writerow(row)
+
+def write_viewing_options_rows(writer, mp, res):
+    check_search_response(mp, res)
+    for huid_bucket in res["aggregations"]["huid"]["buckets"]:
+        huid = huid_bucket["key"]
+        row = {"mpid": mp.mpid, "huid": huid}
+        event_buckets = huid_bucket["paella_events"]["buckets"]
+        for event_type, stats in event_buckets.items():
+            row[event_type] = stats["doc_count"]
+        writer.writerow(row)
 
 
 @export.command()
@@ -89,36 +175,113 @@ def viewing_options(es_host, term, year):
 @click.option("--year")
 @click.option("--chunk-interval", type=int, default=300)
 @click.option("--live/--no-live", default=False)
-def attendance(es_host, term, year, chunk_interval, live):
-    es = es_connection(es_host)
-    mps = get_episodes_for_term(es, term, year, fields=["mpid", "duration"])
-
+@click.option(
+    "--mpids-per-query",
+    type=int,
+    default=25,
+    help="number of episodes aggregated by each elasticsearch query; "
+    "0 aggregates the whole term in a single query",
+)
+@click.option(
+    "--engine",
+    type=click.Choice(["histogram", "coverage"]),
+    default="histogram",
+    help="'histogram' counts --chunk-interval buckets containing a "
+    "heartbeat; 'coverage' computes exact seconds watched from the "
+    "streamed heartbeats (requires numpy)",
+)
+@click.option(
+    "--heartbeat-interval",
+    type=int,
+    default=30,
+    help="seconds covered by a heartbeat without a usable outpoint "
+    "(coverage engine only)",
+)
+@click.option(
+    "--concurrency",
+    default=4,
+    help="number of episodes streamed concurrently (coverage engine only)",
+)
+@click.option(
+    "--source",
+    type=click.Choice(["useractions", "rollups"]),
+    default="useractions",
+    help="compute from raw useractions or from the rollups maintained "
+    "by the rollup command",
+)
+@output_options
+def attendance(
+    es_host,
+    term,
+    year,
+    chunk_interval,
+    live,
+    mpids_per_query,
+    engine,
+    heartbeat_interval,
+    concurrency,
+    source,
+    fmt,
+    output,
+):
     attendance_column = live and "live_attendance" or "vod_attendance"
     duration_attr = live and "live_duration" or "duration"
 
-    writer = DictWriter(
-        sys.stdout,
-        fieldnames=["mpid", "huid", attendance_column],
-    )
-    writer.writeheader()
+    es = es_connection(es_host)
+    mps = get_episodes_for_term(es, term, year, fields=["mpid", duration_attr])
+
+    writer = open_writer(fmt, output, attendance_columns(live))
+
+    if source == "rollups":
+        write_rollup_attendance(
+            writer,
+            es,
+            mps,
+            live,
+            chunk_interval,
+            duration_attr,
+            attendance_column,
+        )
+        writer.close()
+        return
+
+    if engine == "coverage":
+        write_coverage_attendance(
+            writer,
+            es,
+            mps,
+            live,
+            duration_attr,
+            attendance_column,
+            heartbeat_interval,
+            concurrency,
+        )
+        writer.close()
+        return
 
-    for mp in mps:
+    for batch in chunks(mps, mpids_per_query or max(len(mps), 1)):
         s = Search(using=es, index="useractions-*").extra(size=0)
         s = s.filter(
-            Q("term", mpid=mp.mpid)
+            Q("terms", mpid=[mp.mpid for mp in batch])
             & Q("term", is_live=int(live))
             & Q("term", **{"action.is_playing": True})
             & Q("term", **{"action.type": "HEARTBEAT"})
             & ~Q("term", huid="anonymous")
         )
         s.aggs.bucket(
+            name="mpid",
+            agg_type="terms",
+            field="mpid",
+            size=0,
+        )
+        s.aggs["mpid"].bucket(
             name="huid",
             agg_type="terms",
             field="huid",
             size=0,
         )
 
-        s.aggs["huid"].bucket(
+        s.aggs["mpid"]["huid"].bucket(
             name="inpoints",
             agg_type="histogram",
             field="action.inpoint",
@@ -127,32 +290,230 @@ def attendance(es_host, term, year, chunk_interval, live):
         )
 
         res = s.execute().to_dict()
-        duration = getattr(mp, duration_attr, None)
+        mpid_buckets = dict(
+            (x["key"], x) for x in res["aggregations"]["mpid"]["buckets"]
+        )
+        spans = heartbeat_span_buckets(
+            es,
+            "useractions-*",
+            [mp.mpid for mp in batch],
+            chunk_interval,
+            live,
+        )
+
+        # rows are written in episode order, same as querying per mpid
+        for mp in batch:
+            total_intervals = attendance_intervals(
+                mp, duration_attr, chunk_interval
+            )
+            if total_intervals is None:
+                continue
+
+            huid_buckets = []
+            if mp.mpid in mpid_buckets:
+                huid_buckets = mpid_buckets[mp.mpid]["huid"]["buckets"]
+            viewers = attendance_viewers(
+                (
+                    (x["key"], x["doc_count"], x["inpoints"]["buckets"])
+                    for x in huid_buckets
+                ),
+                spans.get(mp.mpid, {}),
+            )
+            write_attendance_rows(
+                writer, mp, viewers, total_intervals, attendance_column
+            )
+
+        time.sleep(0.05)
+
+    writer.close()
+
+
+def attendance_columns(live):
+    attendance_column = live and "live_attendance" or "vod_attendance"
+    return [
+        ("mpid", "category"),
+        ("huid", "category"),
+        (attendance_column, "int16"),
+    ]
+
+
+# an episode's attendance rows are ordered by heartbeat count, most first,
+# then by huid
+def attendance_order(huid, heartbeats):
+    return -heartbeats, huid
+
+
+def attendance_viewers(huid_buckets, spans):
+    """
+    Merges an episode's heartbeat histogram, given as (huid, heartbeats,
+    inpoint buckets) triples, with its heartbeat spans into a dict of huid
+    to (set of inpoint bucket keys, heartbeat count)
+    """
+    viewers = {}
+    for huid, heartbeats, buckets in huid_buckets:
+        viewers[huid] = (set(int(x["key"]) for x in buckets), heartbeats)
+    for (huid, _), (buckets, heartbeats) in spans.items():
+        prev_buckets, prev_heartbeats = viewers.get(huid, (set(), 0))
+        viewers[huid] = (prev_buckets | buckets, prev_heartbeats + heartbeats)
+    return viewers
+
+
+def write_attendance_rows(
+    writer, mp, viewers, total_intervals, attendance_column
+):
+    for huid, (buckets, heartbeats) in sorted(
+        viewers.items(), key=lambda x: attendance_order(x[0], x[1][1])
+    ):
+        if heartbeats == 0:
+            continue
+        pct_watched = int(100.0 * (len(buckets) / total_intervals))
+        writer.writerow(
+            {"huid": huid, "mpid": mp.mpid, attendance_column: pct_watched}
+        )
+
+
+def attendance_intervals(mp, duration_attr, chunk_interval):
+    """
+    Returns the number of `chunk_interval` chunks in the episode, or None
+    if attendance can't be computed for it
+    """
+    duration = getattr(mp, duration_attr, None)
 
+    if duration is None:
+        logger.warning("'%s' is missing for mpid %s", duration_attr, mp.mpid)
+        return None
+
+    total_intervals = ceil((duration / 1000) / chunk_interval)
+
+    if total_intervals == 0:
+        logger.warning("zero intervals for mpid %s", mp.mpid)
+        return None
+
+    return total_intervals
+
+
+def write_rollup_attendance(
+    writer, es, mps, live, chunk_interval, duration_attr, attendance_column
+):
+    for batch in chunks(mps, ROLLUP_BATCH_SIZE):
+        chunks_watched = rollup_attendance(
+            es, [mp.mpid for mp in batch], live, chunk_interval
+        )
+        for mp in batch:
+            total_intervals = attendance_intervals(
+                mp, duration_attr, chunk_interval
+            )
+            if total_intervals is None:
+                continue
+
+            for huid, interval_buckets in sorted(
+                chunks_watched[mp.mpid].items()
+            ):
+                pct_watched = int(100.0 * (interval_buckets / total_intervals))
+                writer.writerow(
+                    {
+                        "huid": huid,
+                        "mpid": mp.mpid,
+                        attendance_column: pct_watched,
+                    }
+                )
+
+
+def write_coverage_attendance(
+    writer,
+    es,
+    mps,
+    live,
+    duration_attr,
+    attendance_column,
+    heartbeat_interval,
+    concurrency,
+):
+    # only required for this engine
+    try:
+        import numpy as np
+    except ImportError:
+        raise click.ClickException(
+            "--engine coverage requires numpy; see optional-requirements.txt"
+        )
+
+    def coverage(mp):
+        duration = getattr(mp, duration_attr, None)
         if duration is None:
             logger.warning(
                 "'%s' is missing for mpid %s", duration_attr, mp.mpid
             )
-            continue
+            return {}
 
-        total_intervals = ceil((mp.duration / 1000) / chunk_interval)
+        total_seconds = int(ceil(duration / 1000))
+        if total_seconds == 0:
+            logger.warning("zero duration for mpid %s", mp.mpid)
+            return {}
 
-        if total_intervals == 0:
-            logger.warning("zero intervals for mpid %s", mp.mpid)
-            continue
-
-        for huid in res["aggregations"]["huid"]["buckets"]:
-            interval_buckets = len(huid["inpoints"]["buckets"])
+        s = Search().filter(
+            Q("term", mpid=mp.mpid)
+            & Q("term", is_live=int(live))
+            & Q("term", **{"action.is_playing": True})
+            # spans from `useractions --coalesce-heartbeats` cover the
+            # heartbeats they replace
+            & Q("terms", **{"action.type": ["HEARTBEAT", "HEARTBEAT_SPAN"]})
+            & ~Q("term", huid="anonymous")
+        )
+        s = s.source(
+            include=[
+                "huid",
+                "action.type",
+                "action.inpoint",
+                "action.outpoint",
+                "span.end_inpoint",
+            ]
+        )
 
-            pct_watched = int(100.0 * (interval_buckets / total_intervals))
-            row = {
-                "huid": huid["key"],
-                "mpid": mp.mpid,
-                attendance_column: pct_watched,
-            }
-            writer.writerow(row)
+        # one second-resolution bitmap per huid; memory is bounded by the
+        # episode's duration times the number of viewers
+        bitmaps = {}
+        for hit in scan(
+            es, query=s.to_dict(), index="useractions-*", size=1000
+        ):
+            doc = hit["_source"]
+            action = doc.get("action", {})
+            try:
+                start = int(action["inpoint"])
+            except (KeyError, TypeError, ValueError):
+                continue
+            try:
+                end = int(action["outpoint"])
+            except (KeyError, TypeError, ValueError):
+                end = start
+            if end <= start:
+                end = start + heartbeat_interval
+            elif (
+                action.get("type") == "HEARTBEAT_SPAN"
+                and doc.get("span", {}).get("end_inpoint") == end
+            ):
+                # the span's last heartbeat had no usable outpoint
+                end += heartbeat_interval
+
+            huid = doc["huid"]
+            if huid not in bitmaps:
+                bitmaps[huid] = np.zeros(total_seconds, dtype=bool)
+            bitmaps[huid][max(start, 0) : min(end, total_seconds)] = True
+
+        return dict(
+            (huid, int(100.0 * np.count_nonzero(bm) / total_seconds))
+            for huid, bm in bitmaps.items()
+        )
 
-        sleep(0.05)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for mp, pcts in zip(mps, executor.map(coverage, mps)):
+            for huid in sorted(pcts):
+                writer.writerow(
+                    {
+                        "huid": huid,
+                        "mpid": mp.mpid,
+                        attendance_column: pcts[huid],
+                    }
+                )
 
 
 @export.command()
@@ -160,58 +521,414 @@ def attendance(es_host, term, year, chunk_interval, live):
 @click.option("--banner", envvar="BANNER_ENDPOINT_BASE")
 @click.option("--term")
 @click.option("--year")
-def rollcall(es_host, banner, term, year):
-    banner = Banner(banner)
+@click.option(
+    "--concurrency",
+    default=4,
+    help="max number of banner requests in flight",
+)
+@click.option(
+    "--rate",
+    default=1.0,
+    type=click.FloatRange(min=0, min_open=True),
+    help="max banner requests per second",
+)
+@click.option(
+    "--roster-cache",
+    envvar="ROSTER_CACHE_DIR",
+    help="directory to cache course rosters in; defaults to "
+    "$ROSTER_CACHE_DIR",
+)
+@click.option(
+    "--roster-cache-ttl",
+    default=ROSTER_CACHE_TTL,
+    help="seconds before a cached roster is fetched again",
+)
+@click.option(
+    "--cache-only",
+    is_flag=True,
+    help="only use cached rosters, regardless of age; courses that "
+    "aren't cached are skipped",
+)
+@output_options
+def rollcall(
+    es_host,
+    banner,
+    term,
+    year,
+    concurrency,
+    rate,
+    roster_cache,
+    roster_cache_ttl,
+    cache_only,
+    fmt,
+    output,
+):
+    cache = None
+    if roster_cache is not None:
+        cache = RosterCache(roster_cache, roster_cache_ttl)
+    elif cache_only:
+        raise click.UsageError("--cache-only requires --roster-cache")
+
+    banner = Banner(banner, rate_limiter=RateLimiter(1.0 / rate), cache=cache)
     es = es_connection(es_host)
     series = get_series_for_term(es, term, year)
 
-    writer = DictWriter(
-        sys.stdout,
-        extrasaction="ignore",
-        fieldnames=[
-            "series",
-            "huid",
-            "status",
-            "first_name",
-            "mi",
-            "last_name",
-            "reg_level",
-        ],
-    )
-    writer.writeheader()
+    writer = open_writer(fmt, output, ROLLCALL_COLUMNS, extrasaction="ignore")
+    write_rollcall(writer, banner, series, term, year, concurrency, cache_only)
+    writer.close()
+
 
-    for series_id in series:
+def write_rollcall(
+    writer, banner, series, term, year, concurrency, cache_only
+):
+    def course_people(series_id):
         crn = series_id[6:]
-        people = banner.get_course_people(term, year, crn)
-        for person in people:
-            # no middle initial value is represented by an empty dict
-            if not isinstance(person["mi"], str):
-                person["mi"] = ""
-            person["series"] = series_id
-            writer.writerow(person)
-        sleep(1)
+        if cache_only:
+            people = banner.cache.get(term, year, crn, max_age=None)
+            if people is None:
+                logger.warning("No cached roster for series %s", series_id)
+                return []
+            return people
+        return banner.get_course_people(term, year, crn)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for series_id, people in zip(
+            series, executor.map(course_people, series)
+        ):
+            for person in people:
+                # no middle initial value is represented by an empty dict
+                if not isinstance(person["mi"], str):
+                    person["mi"] = ""
+                person["series"] = series_id
+                writer.writerow(person)
+
+
+@export.command(name="all")
+@click.option("--es_host", envvar="ES_HOST")
+@click.option("--banner", envvar="BANNER_ENDPOINT_BASE")
+@click.option("--term")
+@click.option("--year")
+@click.option(
+    "--reports",
+    default=",".join(REPORTS),
+    help="comma separated reports to write; defaults to all of %s"
+    % ", ".join(REPORTS),
+)
+@click.option(
+    "--output-dir",
+    required=True,
+    help="directory to write the reports to, one <report>.<format> each",
+)
+@click.option(
+    "--format",
+    "fmt",
+    type=click.Choice(FORMATS),
+    default="csv",
+    help="output format; parquet and arrow require pyarrow",
+)
+@click.option("--chunk-interval", type=int, default=300)
+@click.option("--live/--no-live", default=False)
+@click.option(
+    "--batch-size",
+    default=50,
+    help="number of episode searches sent per msearch request",
+)
+@click.option(
+    "--concurrency",
+    default=4,
+    help="max number of msearch and banner requests in flight",
+)
+@click.option(
+    "--rate",
+    default=1.0,
+    type=click.FloatRange(min=0, min_open=True),
+    help="max banner requests per second",
+)
+@click.option(
+    "--roster-cache",
+    envvar="ROSTER_CACHE_DIR",
+    help="directory to cache course rosters in; defaults to "
+    "$ROSTER_CACHE_DIR",
+)
+@click.option(
+    "--roster-cache-ttl",
+    default=ROSTER_CACHE_TTL,
+    help="seconds before a cached roster is fetched again",
+)
+def export_all(
+    es_host,
+    banner,
+    term,
+    year,
+    reports,
+    output_dir,
+    fmt,
+    chunk_interval,
+    live,
+    batch_size,
+    concurrency,
+    rate,
+    roster_cache,
+    roster_cache_ttl,
+):
+    """
+    Writes several reports from a single pass over the term's episodes
+    """
+    reports = [x.strip() for x in reports.split(",") if x.strip()]
+    for report in reports:
+        if report not in REPORTS:
+            raise click.BadParameter(
+                "unknown report '%s'" % report, param_hint="--reports"
+            )
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    def report_writer(report, columns, **kwargs):
+        output = os.path.join(output_dir, "%s.%s" % (report, fmt))
+        return open_writer(fmt, output, columns, **kwargs)
+
+    es = es_connection(es_host)
+    # series is fetched so rollcall doesn't need its own aggregation
+    mps = get_episodes_for_term(
+        es, term, year, fields=["mpid", "duration", "live_duration", "series"]
+    )
+
+    with ThreadPoolExecutor(max_workers=concurrency + 1) as executor:
+        rollcall_future = None
+        if "rollcall" in reports:
+            cache = None
+            if roster_cache is not None:
+                cache = RosterCache(roster_cache, roster_cache_ttl)
+            banner = Banner(
+                banner, rate_limiter=RateLimiter(1.0 / rate), cache=cache
+            )
+            writer = report_writer(
+                "rollcall", ROLLCALL_COLUMNS, extrasaction="ignore"
+            )
+            # runs alongside the useractions searches below; the banner
+            # requests get their own pool so neither waits on the other
+            rollcall_future = executor.submit(
+                write_rollcall,
+                writer,
+                banner,
+                term_series(mps),
+                term,
+                year,
+                concurrency,
+                False,
+            )
+            rollcall_future.add_done_callback(lambda f: writer.close())
+
+        viewing_writer = attendance_writer = None
+        if "viewing_options" in reports:
+            viewing_writer = report_writer(
+                "viewing_options", VIEWING_OPTIONS_COLUMNS
+            )
+        if "attendance" in reports:
+            attendance_writer = report_writer(
+                "attendance", attendance_columns(live)
+            )
+
+        if viewing_writer is not None or attendance_writer is not None:
+            write_combined_reports(
+                viewing_writer,
+                attendance_writer,
+                es,
+                mps,
+                live,
+                chunk_interval,
+                batch_size,
+                executor,
+            )
+            for writer_ in (viewing_writer, attendance_writer):
+                if writer_ is not None:
+                    writer_.close()
+
+        if rollcall_future is not None:
+            rollcall_future.result()
+
+
+# distinct series of the episodes, in the order of the series terms
+# aggregation used by get_series_for_term: by episode count, then by name
+def term_series(mps):
+    counts = {}
+    for mp in mps:
+        series = getattr(mp, "series", None)
+        if series is not None:
+            counts[series] = counts.get(series, 0) + 1
+    return sorted(counts, key=lambda x: (-counts[x], x))
+
+
+def write_combined_reports(
+    viewing_writer,
+    attendance_writer,
+    es,
+    mps,
+    live,
+    chunk_interval,
+    batch_size,
+    executor,
+):
+    """
+    Writes viewing_options and attendance rows from one search per episode
+    whose huid buckets carry both the paella event counts and the
+    heartbeat histogram
+    """
+    attendance_column = live and "live_attendance" or "vod_attendance"
+    duration_attr = live and "live_duration" or "duration"
+
+    combined_aggs = {
+        "aggs": {
+            "huid": {
+                "terms": {"size": 0, "field": "huid"},
+                "aggs": {
+                    "paella_events": {
+                        "filters": {"filters": PAELLA_EVENT_FILTERS}
+                    },
+                    "heartbeats": {
+                        "filter": (
+                            Q("term", is_live=int(live))
+                            & Q("term", **{"action.is_playing": True})
+                            & Q("term", **{"action.type": "HEARTBEAT"})
+                        ).to_dict(),
+                        "aggs": {
+                            "inpoints": {
+                                "histogram": {
+                                    "field": "action.inpoint",
+                                    "interval": str(chunk_interval),
+                                    "min_doc_count": 1,
+                                }
+                            }
+                        },
+                    },
+                },
+            }
+        }
+    }
+
+    def search_batch(batch):
+        searches = []
+        for mp in batch:
+            s = Search().extra(size=0)
+            s = s.filter(
+                Q("term", mpid=mp.mpid) & ~Q("term", huid="anonymous")
+            )
+            s.update_from_dict(combined_aggs)
+            searches.append(s.to_dict())
+        spans = {}
+        if attendance_writer is not None:
+            spans = heartbeat_span_buckets(
+                es,
+                "useractions-*",
+                [mp.mpid for mp in batch],
+                chunk_interval,
+                live,
+            )
+        return msearch(es, "useractions-*", searches), spans
+
+    batches = list(chunks(mps, batch_size))
+
+    for batch, (responses, spans) in zip(
+        batches, executor.map(search_batch, batches)
+    ):
+        for mp, res in zip(batch, responses):
+            check_search_response(mp, res)
+            if viewing_writer is not None:
+                write_viewing_options_rows(viewing_writer, mp, res)
+
+            if attendance_writer is None:
+                continue
+            total_intervals = attendance_intervals(
+                mp, duration_attr, chunk_interval
+            )
+            if total_intervals is None:
+                continue
+            # same rows as `export attendance`
+            viewers = attendance_viewers(
+                (
+                    (
+                        x["key"],
+                        x["heartbeats"]["doc_count"],
+                        x["heartbeats"]["inpoints"]["buckets"],
+                    )
+                    for x in res["aggregations"]["huid"]["buckets"]
+                ),
+                spans.get(mp.mpid, {}),
+            )
+            write_attendance_rows(
+                attendance_writer,
+                mp,
+                viewers,
+                total_intervals,
+                attendance_column,
+            )
+
+
+class RosterCache(object):
+    """
+    On-disk cache of banner course rosters keyed by (year, term, crn)
+    """
+
+    def __init__(self, cache_dir, ttl=ROSTER_CACHE_TTL):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, term, year, crn):
+        return os.path.join(self.cache_dir, year + term, "%s.json" % crn)
+
+    def get(self, term, year, crn, max_age=-1):
+        """
+        Returns the cached roster, or None if it's missing or older than
+        `max_age` seconds (the cache ttl by default; None for any age)
+        """
+        if max_age == -1:
+            max_age = self.ttl
+        cached = read_json_file(self.path(term, year, crn))
+        if cached is None:
+            return None
+        if max_age is not None and time.time() - cached["fetched"] > max_age:
+            return None
+        return cached["people"]
+
+    def set(self, term, year, crn, people):
+        write_json_file(
+            self.path(term, year, crn),
+            {"fetched": time.time(), "people": people},
+        )
 
 
 class Banner(object):
-    def __init__(self, endpoint_base):
+    def __init__(self, endpoint_base, rate_limiter=None, cache=None):
 
         self.endpoint_base = endpoint_base
+        self.rate_limiter = rate_limiter
+        self.cache = cache
 
     def get_course_people(self, term, year, crn):
 
+        if self.cache is not None:
+            people = self.cache.get(term, year, crn)
+            if people is not None:
+                return people
+
         params = {"fmt": "json", "term": year + term, "crn": crn}
 
         endpoint_url = urljoin(self.endpoint_base, "__get_course_people.php")
-        resp = requests.get(endpoint_url, params=params)
-        resp_data = resp.json()
-
-        if "people" not in resp_data:
-            return []
-
-        groups = []
-        for group in resp_data["people"].values():
-            if isinstance(group, list):
-                groups.append(group)
-            elif isinstance(group, dict):
-                groups.append([group])
-        return list(itertools.chain.from_iterable([x for x in groups]))
+        resp_data = client.request_json(
+            "get", endpoint_url, params=params, rate_limiter=self.rate_limiter
+        )
+
+        people = []
+        if "people" in resp_data:
+            groups = []
+            for group in resp_data["people"].values():
+                if isinstance(group, list):
+                    groups.append(group)
+                elif isinstance(group, dict):
+                    groups.append([group])
+            people = list(itertools.chain.from_iterable([x for x in groups]))
+
+        if self.cache is not None:
+            self.cache.set(term, year, crn, people)
+        return people
@@ -1,67 +1,410 @@
+import json
+import redis
+import sqlite3
 import maxminddb
 import logging
+import ipaddress
+import threading
+import multiprocessing
+from collections import OrderedDict
 
 logger = logging.getLogger(__name__)
 
+OPEN_MODES = ["auto", "mmap", "memory"]
+
+DEFAULT_CACHE_SIZE = 10000
+
+# smallest number of cache misses in a `get_many` batch that is worth
+# handing off to the process pool
+POOL_MIN_BATCH = 1000
+
+# persistent cache entries expire after this many seconds (redis only)
+GEO_CACHE_TTL = 30 * 24 * 60 * 60
+
 
 class Geolocate:
-    def __init__(self, db):
+    def __init__(
+        self,
+        db,
+        cache_size=DEFAULT_CACHE_SIZE,
+        mode="auto",
+        store=None,
+        processes=None,
+        pool_min_batch=POOL_MIN_BATCH,
+    ):
         self.__db = db
-        self.__cache = {}
+        self.__mode = mode
+        # worker processes used by `get_many` for large batches of misses
+        self.__processes = processes
+        self.__pool_min_batch = pool_min_batch
+        self.__pool = None
+        # optional persistent cache shared between runs/commands; see
+        # `open_geo_cache`
+        self.__store = store
+        # lru cache of geoip data keyed by (ip version, prefix length,
+        # network bits) so one entry serves every ip in the network block
+        self.__cache = OrderedDict()
+        self.__cache_size = cache_size
+        # prefix lengths of the cached networks, per ip version
+        self.__prefix_lens = {4: set(), 6: set()}
+        # zoom backfills share one instance between threads
+        self.__lock = threading.Lock()
+        self.hits = 0
+        self.store_hits = 0
+        self.misses = 0
+        self.evictions = 0
         self.__open_reader()
+        if self.__store is not None:
+            # entries are tagged with the database build so a new
+            # GEOLITE_PATH database invalidates them
+            self.__store.bind(self.__reader.metadata().build_epoch)
+            self.__store_prefix_lens = {
+                4: self.__store.prefix_lens(4),
+                6: self.__store.prefix_lens(6),
+            }
 
     def close(self):
         self.__reader.close()
+        if self.__pool is not None:
+            self.__pool.close()
+            self.__pool.join()
+        if self.__store is not None:
+            self.__store.close()
+
+    def stats(self):
+        lookups = self.hits + self.store_hits + self.misses
+        return {
+            "hits": self.hits,
+            "store_hits": self.store_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self.__cache),
+            "hit_rate": lookups
+            and float(self.hits + self.store_hits) / lookups
+            or 0.0,
+        }
 
     # fetch from cache or make new call to db
     def get(self, ip):
-        if ip in self.__cache:
-            return self.__cache[ip]
+        addr = ipaddress.ip_address(ip)
+        geoip = self.__cached(addr)
+        if geoip is None:
+            self.misses += 1
+            geoip = self.__new_lookup(addr)
+
+        geoip = dict({"ip": ip}, **geoip)
+        logger.debug(geoip)
+        return geoip
+
+    def get_many(self, ips):
+        """
+        Geolocate a batch of ips, returning results aligned with `ips`.
+        Duplicate ips are looked up once and anything already cached is
+        served from the cache. If the instance was created with `processes`
+        and enough ips miss the cache, the remainder is resolved by a pool of
+        worker processes, each with its own mmap'd reader. Unparseable
+        addresses get None.
+        """
+        resolved = {}
+        misses = []
+
+        for ip in OrderedDict.fromkeys(ips):
+            try:
+                addr = ipaddress.ip_address(ip)
+            except ValueError:
+                logger.warning("Not geolocating invalid ip '%s'", ip)
+                resolved[ip] = None
+                continue
+
+            geoip = self.__cached(addr)
+            if geoip is None:
+                misses.append((ip, addr))
+            else:
+                resolved[ip] = geoip
+
+        if self.__processes and len(misses) >= self.__pool_min_batch:
+            found = self.__get_pool().map(
+                _pool_lookup,
+                [str(addr) for ip, addr in misses],
+                chunksize=max(1, len(misses) // (self.__processes * 4)),
+            )
+            for (ip, addr), (ipdata, prefix_len) in zip(misses, found):
+                self.misses += 1
+                resolved[ip] = self.__record(addr, ipdata, prefix_len)
         else:
-            return self.__new_lookup(ip)
+            for ip, addr in misses:
+                # an earlier miss in this batch may have cached the network
+                geoip = self.__cache_get(addr)
+                if geoip is None:
+                    self.misses += 1
+                    geoip = self.__new_lookup(addr)
+                else:
+                    self.hits += 1
+                resolved[ip] = geoip
+
+        return [
+            resolved[ip] is not None
+            and dict({"ip": ip}, **resolved[ip])
+            or None
+            for ip in ips
+        ]
+
+    def __cached(self, addr):
+        geoip = self.__cache_get(addr)
+        if geoip is not None:
+            self.hits += 1
+            return geoip
+        geoip = self.__store_get(addr)
+        if geoip is not None:
+            self.store_hits += 1
+        return geoip
+
+    def __get_pool(self):
+        with self.__lock:
+            if self.__pool is None:
+                # spawn rather than fork; callers such as zoom backfills have
+                # other threads running
+                ctx = multiprocessing.get_context("spawn")
+                self.__pool = ctx.Pool(
+                    self.__processes,
+                    initializer=_init_pool_worker,
+                    initargs=(self.__db,),
+                )
+            return self.__pool
 
     def __open_reader(self):
-        self.__reader = maxminddb.open_database(self.__db)
+        if self.__mode == "memory":
+            mode = maxminddb.MODE_MEMORY
+        elif self.__mode == "mmap":
+            # prefer the C extension's mmap reader when it's installed
+            if getattr(maxminddb.extension, "Reader", None) is not None:
+                mode = maxminddb.MODE_MMAP_EXT
+            else:
+                mode = maxminddb.MODE_MMAP
+        else:
+            mode = maxminddb.MODE_AUTO
+        self.__reader = maxminddb.open_database(self.__db, mode)
 
-    def __new_lookup(self, ip):
-        ipdata = self.__reader.get(ip)
+    def __cache_key(self, addr, prefix_len):
+        return (
+            addr.version,
+            prefix_len,
+            int(addr) >> (addr.max_prefixlen - prefix_len),
+        )
 
-        geoip = {"ip": ip}
+    def __cache_get(self, addr):
+        with self.__lock:
+            for prefix_len in self.__prefix_lens[addr.version]:
+                key = self.__cache_key(addr, prefix_len)
+                if key in self.__cache:
+                    self.__cache.move_to_end(key)
+                    return self.__cache[key]
+        return None
 
-        if "country" in ipdata:
-            geoip["country_code2"] = ipdata["country"]["iso_code"]
-            geoip["country_code3"] = ipdata["country"]["names"]["de"]
-            geoip["country_name"] = ipdata["country"]["names"]["en"]
+    def __cache_set(self, addr, prefix_len, geoip):
+        key = self.__cache_key(addr, prefix_len)
+        with self.__lock:
+            self.__cache[key] = geoip
+            self.__prefix_lens[addr.version].add(prefix_len)
+            if len(self.__cache) > self.__cache_size:
+                self.__cache.popitem(last=False)
+                self.evictions += 1
 
-        if "continent" in ipdata:
-            geoip["continent_code"] = ipdata["continent"]["code"]
+    def __store_get(self, addr):
+        if self.__store is None:
+            return None
+        with self.__lock:
+            prefix_lens = list(self.__store_prefix_lens[addr.version])
+        keys = [network_key(addr, prefix_len) for prefix_len in prefix_lens]
+        entry = self.__store.lookup(keys)
+        if entry is None:
+            return None
+        self.__cache_set(addr, entry["prefix_len"], entry["geoip"])
+        return entry["geoip"]
 
-        if "subdivisions" in ipdata:
-            geoip["region_name"] = [
-                s["iso_code"] for s in ipdata["subdivisions"]
-            ]
-            geoip["real_region_name"] = [
-                s["names"]["en"] for s in ipdata["subdivisions"]
-            ]
+    def __new_lookup(self, addr):
+        ipdata, prefix_len = self.__reader.get_with_prefix_len(str(addr))
+        return self.__record(addr, ipdata, prefix_len)
 
-        if "city" in ipdata:
-            geoip["city_name"] = ipdata["city"]["names"]["en"]
+    def __record(self, addr, ipdata, prefix_len):
+        # ipv4 lookups in an ipv6 database may report an ipv6 prefix length
+        if prefix_len > addr.max_prefixlen:
+            prefix_len -= 96
+        geoip = build_geoip(ipdata or {})
+        self.__cache_set(addr, prefix_len, geoip)
+        if self.__store is not None:
+            self.__store.store(
+                network_key(addr, prefix_len),
+                {"prefix_len": prefix_len, "geoip": geoip},
+                addr.version,
+                prefix_len,
+            )
+            with self.__lock:
+                self.__store_prefix_lens[addr.version].add(prefix_len)
+        return geoip
 
-        if "location" in ipdata:
-            loc = ipdata["location"]
 
-            if "latitude" in loc and "longitude" in loc:
-                lat, lng = loc["latitude"], loc["longitude"]
-                geoip["latitude"], geoip["longitude"] = lat, lng
-                geoip["location"] = [lng, lat]
+# reader for process pool workers; see `Geolocate.get_many`
+_pool_reader = None
 
-            if "metro_code" in loc:
-                geoip["dma_code"] = loc["metro_code"]
 
-            if "timezone" in loc:
-                geoip["timezone"] = loc["time_zone"]
+def _init_pool_worker(db):
+    global _pool_reader
+    _pool_reader = maxminddb.open_database(db, maxminddb.MODE_MMAP)
 
-        self.__cache[ip] = geoip
-        logger.debug(geoip)
 
-        return geoip
+def _pool_lookup(ip):
+    return _pool_reader.get_with_prefix_len(ip)
+
+
+def network_key(addr, prefix_len):
+    network = ipaddress.ip_network("%s/%d" % (addr, prefix_len), strict=False)
+    return str(network)
+
+
+def open_geo_cache(spec):
+    """
+    Returns a persistent geolocation cache for `spec`, which is either a
+    redis url (redis://host:port/db) or the path of a sqlite database file
+    """
+    if spec.startswith(("redis://", "rediss://", "unix://")):
+        return RedisGeoCache(spec)
+    return SqliteGeoCache(spec)
+
+
+class RedisGeoCache(object):
+    def __init__(self, url, ttl=GEO_CACHE_TTL):
+        self.redis = redis.StrictRedis.from_url(url)
+        self.ttl = ttl
+        self.namespace = None
+
+    def bind(self, epoch):
+        self.namespace = "geoip:%s" % epoch
+
+    def prefix_lens(self, version):
+        members = self.redis.smembers(
+            "%s:prefixes:%d" % (self.namespace, version)
+        )
+        return set(int(x) for x in members)
+
+    def lookup(self, keys):
+        if len(keys) == 0:
+            return None
+        values = self.redis.mget(["%s:%s" % (self.namespace, k) for k in keys])
+        for value in values:
+            if value is not None:
+                return json.loads(value.decode("utf-8"))
+        return None
+
+    def store(self, key, value, version, prefix_len):
+        prefixes_key = "%s:prefixes:%d" % (self.namespace, version)
+        pipe = self.redis.pipeline()
+        pipe.setex(
+            "%s:%s" % (self.namespace, key), self.ttl, json.dumps(value)
+        )
+        pipe.sadd(prefixes_key, prefix_len)
+        pipe.expire(prefixes_key, self.ttl)
+        pipe.execute()
+
+    def close(self):
+        pass
+
+
+class SqliteGeoCache(object):
+    def __init__(self, path):
+        self.__conn = sqlite3.connect(
+            path, timeout=30, check_same_thread=False
+        )
+        self.__lock = threading.Lock()
+        with self.__lock, self.__conn:
+            # allow concurrent readers while another command is writing
+            self.__conn.execute("PRAGMA journal_mode=WAL")
+            self.__conn.execute("PRAGMA synchronous=NORMAL")
+            self.__conn.execute(
+                "CREATE TABLE IF NOT EXISTS geoip "
+                "(network TEXT PRIMARY KEY, version INTEGER, "
+                "prefix_len INTEGER, value TEXT)"
+            )
+            self.__conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta "
+                "(name TEXT PRIMARY KEY, value TEXT)"
+            )
+
+    def bind(self, epoch):
+        with self.__lock, self.__conn:
+            row = self.__conn.execute(
+                "SELECT value FROM meta WHERE name = 'build_epoch'"
+            ).fetchone()
+            if row is None or row[0] != str(epoch):
+                logger.info("Clearing geolocation cache for new database")
+                self.__conn.execute("DELETE FROM geoip")
+                self.__conn.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('build_epoch', ?)",
+                    (str(epoch),),
+                )
+
+    def prefix_lens(self, version):
+        with self.__lock:
+            rows = self.__conn.execute(
+                "SELECT DISTINCT prefix_len FROM geoip WHERE version = ?",
+                (version,),
+            ).fetchall()
+        return set(x[0] for x in rows)
+
+    def lookup(self, keys):
+        if len(keys) == 0:
+            return None
+        with self.__lock:
+            row = self.__conn.execute(
+                "SELECT value FROM geoip WHERE network IN (%s) LIMIT 1"
+                % ",".join("?" * len(keys)),
+                keys,
+            ).fetchone()
+        return row and json.loads(row[0]) or None
+
+    def store(self, key, value, version, prefix_len):
+        with self.__lock, self.__conn:
+            self.__conn.execute(
+                "INSERT OR REPLACE INTO geoip VALUES (?, ?, ?, ?)",
+                (key, version, prefix_len, json.dumps(value)),
+            )
+
+    def close(self):
+        self.__conn.close()
+
+
+def build_geoip(ipdata):
+    geoip = {}
+
+    if "country" in ipdata:
+        geoip["country_code2"] = ipdata["country"]["iso_code"]
+        geoip["country_code3"] = ipdata["country"]["names"]["de"]
+        geoip["country_name"] = ipdata["country"]["names"]["en"]
+
+    if "continent" in ipdata:
+        geoip["continent_code"] = ipdata["continent"]["code"]
+
+    if "subdivisions" in ipdata:
+        geoip["region_name"] = [s["iso_code"] for s in ipdata["subdivisions"]]
+        geoip["real_region_name"] = [
+            s["names"]["en"] for s in ipdata["subdivisions"]
+        ]
+
+    if "city" in ipdata:
+        geoip["city_name"] = ipdata["city"]["names"]["en"]
+
+    if "location" in ipdata:
+        loc = ipdata["location"]
+
+        if "latitude" in loc and "longitude" in loc:
+            lat, lng = loc["latitude"], loc["longitude"]
+            geoip["latitude"], geoip["longitude"] = lat, lng
+            geoip["location"] = [lng, lat]
+
+        if "metro_code" in loc:
+            geoip["dma_code"] = loc["metro_code"]
+
+        if "timezone" in loc:
+            geoip["timezone"] = loc["time_zone"]
+
+    return geoip
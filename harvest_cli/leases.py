@@ -0,0 +1,87 @@
+import os
+import socket
+import logging
+import threading
+from uuid import uuid4
+
+logger = logging.getLogger(__name__)
+
+# only the holder may extend or release a lease
+EXTEND_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("pexpire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class LeaseLostError(Exception):
+    pass
+
+
+class Lease(object):
+    """
+    A redis lease that expires `ttl` seconds after it was last extended.
+    While the lease is used as a context manager it's extended every
+    `ttl / 3` seconds and released on exit; if the holder crashes it
+    simply expires and can be claimed by someone else.
+    """
+
+    def __init__(self, redis_client, key, ttl):
+        self.redis = redis_client
+        self.key = key
+        self.ttl = ttl
+        self.token = "%s:%d:%s" % (socket.gethostname(), os.getpid(), uuid4())
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def acquire(self):
+        return bool(
+            self.redis.set(
+                self.key, self.token, nx=True, px=int(self.ttl * 1000)
+            )
+        )
+
+    def extend(self):
+        return bool(
+            self.redis.eval(
+                EXTEND_SCRIPT, 1, self.key, self.token, int(self.ttl * 1000)
+            )
+        )
+
+    def release(self):
+        self.redis.eval(RELEASE_SCRIPT, 1, self.key, self.token)
+
+    def check(self):
+        if self.lost:
+            raise LeaseLostError("Lost lease %s" % self.key)
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.ttl / 3.0):
+            try:
+                extended = self.extend()
+            except Exception as e:
+                logger.warning("Failed extending lease %s: %s", self.key, e)
+                continue
+            if not extended:
+                logger.error("Lease %s expired or was taken over", self.key)
+                self.lost = True
+                return
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._heartbeat, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        if not self.lost:
+            self.release()
@@ -7,8 +7,17 @@ import arrow
 import redis
 from os import getenv
 from pyhorn.endpoints.search import SearchEpisode
+from pyhorn.endpoints.search import SearchEndpoint
+from pyhorn.endpoints.usertracking import UserAction, UserTrackingEndpoint
 
 import re
+import threading
+from requests.auth import HTTPDigestAuth
+from contextlib import closing
+from itertools import chain, islice
+from urllib.parse import urljoin, urlparse
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
 
 import pyhorn
 
@@ -21,11 +30,40 @@ import time
 from botocore.exceptions import ClientError
 
 from harvest_cli import cli
+from . import client
 from .utils import es_connection, get_mpids_from_useractions
+from .geolocation import Geolocate, open_geo_cache
+from .leases import Lease, LeaseLostError
+from .sinks import (
+    StdoutSink,
+    SqsSink,
+    PackedSqsSink,
+    DeadLetterSpool,
+    SinkError,
+    PACKED_MAX_BYTES,
+)
 
 MAX_START_END_SPAN = getenv("MAX_START_END_SPAN", 0)
 EPISODE_CACHE_EXPIRE = getenv("EPISODE_CACHE_EXPIRE", 15 * 60)
 
+WINDOWS_DONE_KEY = "useractions:windows:done"
+WINDOW_LEASE_KEY = "useractions:windows:lease:%d"
+WATERMARK_LEASE_KEY = "useractions:watermark:lease"
+WATERMARK_LEASE_TTL = 30
+# finished windows are remembered for a day past the last harvest timestamp
+WINDOWS_DONE_RETENTION = 24 * 60 * 60
+DEFAULT_WINDOW = 5
+DEFAULT_LEASE_TTL = 60
+
+HEARTBEAT_SPAN_TYPE = "HEARTBEAT_SPAN"
+# paella sends a heartbeat every 30s while the player is open
+DEFAULT_MAX_HEARTBEAT_GAP = 90
+
+DEFAULT_EPISODE_CONCURRENCY = 8
+DEFAULT_EPISODE_HOST_CONCURRENCY = 4
+# actions held at once while their episodes are resolved
+EPISODE_RESOLVE_BATCH_SIZE = 100
+
 import logging
 
 logger = logging.getLogger(__name__)
@@ -35,7 +73,7 @@ s3 = boto3.resource("s3")
 r = redis.StrictRedis()
 
 
-@cli.command()
+@cli.group(invoke_without_command=True)
 @click.option("-s", "--start", help="YYYYMMDDHHmmss")
 @click.option("-e", "--end", help="YYYYMMDDHHmmss; default=now")
 @click.option(
@@ -103,7 +141,86 @@ r = redis.StrictRedis()
     help="Update the last harvested timestamp; "
     "use --no-update-last-ts if backfilling data",
 )
+@click.option(
+    "--geoip/--no-geoip",
+    default=False,
+    help="Add geolocation data for each action's client ip",
+)
+@click.option(
+    "--geolite",
+    envvar="GEOLITE_PATH",
+    help="filepath to geolite database; defaults to $GEOLITE_PATH",
+)
+@click.option(
+    "--geo-cache",
+    envvar="GEO_CACHE",
+    help="persistent geolocation cache shared between runs; a redis url "
+    "or a sqlite file path; defaults to $GEO_CACHE",
+)
+@click.option(
+    "--coalesce-heartbeats",
+    is_flag=True,
+    help="merge consecutive heartbeats of a viewing session into span "
+    "records",
+)
+@click.option(
+    "--max-heartbeat-gap",
+    default=DEFAULT_MAX_HEARTBEAT_GAP,
+    help="seconds between heartbeats after which a new span is started",
+)
+@click.option(
+    "--coordinate",
+    is_flag=True,
+    help="split the harvest into fixed windows leased through redis so "
+    "several nodes can harvest concurrently",
+)
+@click.option(
+    "--window",
+    default=DEFAULT_WINDOW,
+    help="size in minutes of the windows leased with --coordinate",
+)
+@click.option(
+    "--lease-ttl",
+    default=DEFAULT_LEASE_TTL,
+    help="seconds after which the window lease of a crashed node expires",
+)
+@click.option(
+    "--pack-messages",
+    is_flag=True,
+    help="send many compressed records per sqs message; see "
+    "harvest_cli.sinks.unpack_message",
+)
+@click.option(
+    "--pack-max-bytes",
+    default=PACKED_MAX_BYTES,
+    help="max size of a packed sqs message",
+)
+@click.option(
+    "--stream-actions",
+    is_flag=True,
+    help="decode each page of actions incrementally into lean records, "
+    "keeping memory flat for large batch sizes; needs ijson",
+)
+@click.option(
+    "--episode-concurrency",
+    default=DEFAULT_EPISODE_CONCURRENCY,
+    help="number of uncached episodes of a batch fetched concurrently; 0 "
+    "fetches each one as its action is processed",
+)
+@click.option(
+    "--episode-host-concurrency",
+    default=DEFAULT_EPISODE_HOST_CONCURRENCY,
+    help="max concurrent episode requests to any one engage host",
+)
+@click.option(
+    "--dead-letter",
+    envvar="DEAD_LETTER_SPOOL",
+    help="file to spool actions that fail to be processed or sent to, "
+    "for `useractions replay-failed`; defaults to $DEAD_LETTER_SPOOL",
+)
+@click.pass_context
 def useractions(
+    ctx,
     start,
     end,
     wait,
@@ -116,6 +233,20 @@ def useractions(
     interval,
     disable_start_end_span_check,
     update_last_ts,
+    geoip,
+    geolite,
+    geo_cache,
+    coalesce_heartbeats,
+    max_heartbeat_gap,
+    coordinate,
+    window,
+    lease_ttl,
+    pack_messages,
+    pack_max_bytes,
+    stream_actions,
+    episode_concurrency,
+    episode_host_concurrency,
+    dead_letter,
 ):
 
     # we rely on our own redis cache, so disable pyhorn's internal response caching
@@ -127,8 +258,34 @@ def useractions(
         cache_enabled=False,
     )
 
-    if output == "sqs":
-        queue = get_or_create_queue(queue_name)
+    if output == "sqs" and pack_messages:
+        sink = PackedSqsSink(get_or_create_queue(queue_name), pack_max_bytes)
+    elif output == "sqs":
+        sink = SqsSink(get_or_create_queue(queue_name))
+    else:
+        sink = StdoutSink()
+
+    spool = None
+    if dead_letter is not None:
+        spool = DeadLetterSpool(dead_letter)
+
+    g = None
+    if geoip:
+        if geolite is None:
+            raise click.UsageError("--geoip requires a geolite database")
+        g = Geolocate(
+            geolite, store=geo_cache and open_geo_cache(geo_cache) or None
+        )
+
+    if ctx.invoked_subcommand is not None:
+        ctx.obj = {"mh": mh, "sink": sink, "spool": spool, "g": g}
+        if g is not None:
+            ctx.call_on_close(g.close)
+        return
+
+    coalescer = None
+    if coalesce_heartbeats:
+        coalescer = HeartbeatCoalescer(max_heartbeat_gap)
 
     if end is None:
         end = arrow.now().format("YYYYMMDDHHmmss")
@@ -140,8 +297,14 @@ def useractions(
             start = (
                 arrow.now().shift(minutes=-interval).format("YYYYMMDDHHmmss")
             )
+            if coordinate and update_last_ts:
+                # the watermark can only be advanced once it's set
+                start = seed_harvest_ts(
+                    last_action_ts_key, window_start(start, window)
+                )
 
-    logger.info("Fetching user actions from %s to %s", start, end)
+    if not coordinate:
+        logger.info("Fetching user actions from %s to %s", start, end)
 
     start_end_span = arrow.get(end, "YYYYMMDDHHmmss") - arrow.get(
         start, "YYYYMMDDHHmmss"
@@ -161,14 +324,220 @@ def useractions(
             )
             raise click.Abort()
 
+    if stream_actions and not has_ijson():
+        logger.warning(
+            "ijson is not installed; pages of actions will be decoded whole"
+        )
+
+    counts = {"actions": 0, "batches": 0, "failures": 0}
+
+    resolver = None
+    if episode_concurrency > 0:
+        resolver = EpisodeResolver(
+            episode_concurrency, episode_host_concurrency
+        )
+
+    def process(action):
+        try:
+            rec = create_action_rec(action)
+            if g is not None:
+                add_geoip(rec, g)
+            if coalescer is None:
+                ready = [rec]
+            else:
+                ready = coalescer.add(rec)
+        except Exception as e:
+            logger.error(
+                "Exception during rec creation for %s: %s",
+                action.id,
+                str(e),
+            )
+            counts["failures"] += 1
+            if spool is not None:
+                spool.append(str(e), action=action._raw)
+            return
+        for out in ready:
+            send(out)
+
+    def spool_failed(e):
+        logger.error("Exception sending %d recs: %s", len(e.recs), str(e))
+        counts["failures"] += len(e.recs)
+        if spool is not None:
+            for rec in e.recs:
+                spool.append(str(e), rec=rec)
+
+    def send(rec):
+        try:
+            sink.send(rec)
+        except SinkError as e:
+            spool_failed(e)
+        except Exception as e:
+            logger.error(
+                "Exception sending rec for %s: %s", rec["action_id"], str(e)
+            )
+            counts["failures"] += 1
+            if spool is not None:
+                spool.append(str(e), rec=rec)
+
+    def flush():
+        if coalescer is not None:
+            # spans still open at the end of the run are sent as they are
+            for out in coalescer.flush():
+                send(out)
+        try:
+            sink.flush()
+        except SinkError as e:
+            spool_failed(e)
+
+    resolve = resolver and resolver.resolve
+    if coordinate:
+        harvest_windows(
+            mh,
+            start,
+            end,
+            window,
+            lease_ttl,
+            batch_size,
+            wait,
+            process,
+            flush,
+            counts,
+            last_action_ts_key if update_last_ts else None,
+            stream=stream_actions,
+            resolve=resolve,
+        )
+    else:
+        last_action = fetch_actions(
+            mh,
+            start,
+            end,
+            batch_size,
+            wait,
+            process,
+            counts,
+            stream=stream_actions,
+            resolve=resolve,
+        )
+        flush()
+
+    if resolver is not None:
+        resolver.close()
+        logger.info(
+            "Episodes: %d cache hits, %d fetched, %d failed",
+            resolver.hits,
+            resolver.fetched,
+            resolver.failed,
+        )
+
+    if coalescer is not None:
+        logger.info(
+            "Coalesced %d heartbeats into %d spans",
+            coalescer.heartbeats,
+            coalescer.spans,
+        )
+
+    logger.info(
+        "Total actions: %d, total batches: %d, total failed: %d",
+        counts["actions"],
+        counts["batches"],
+        counts["failures"],
+        extra=counts,
+    )
+
+    if g is not None:
+        logger.info(
+            "geolocation cache: %(hits)d hits, %(store_hits)d persistent "
+            "cache hits, %(misses)d misses" % g.stats()
+        )
+        g.close()
+
+    # with --coordinate the timestamp is advanced window by window
+    if update_last_ts and not coordinate:
+        try:
+            if counts["actions"] == 0:
+                last_action_ts = end
+            else:
+                last_action_ts = arrow.get(last_action.created).format(
+                    "YYYYMMDDHHmmss"
+                )
+            set_harvest_ts(last_action_ts_key, last_action_ts)
+            logger.info("Setting last action timestamp to %s", last_action_ts)
+        except Exception as e:
+            logger.error("Failed setting last action timestamp: %s", str(e))
+
+
+@useractions.command()
+@click.pass_obj
+def replay_failed(obj):
+    """
+    Re-process the actions in the --dead-letter spool
+    """
+    spool = obj["spool"]
+    if spool is None:
+        raise click.UsageError("replay-failed requires --dead-letter")
+
+    entries = spool.claim()
+    logger.info("Replaying %d failed actions", len(entries))
+
+    remaining = []
+    ready = []
+    for entry in entries:
+        if "rec" in entry:
+            ready.append(entry)
+            continue
+        try:
+            action = UserAction(entry["action"], obj["mh"])
+            entry["rec"] = create_action_rec(action)
+            if obj["g"] is not None:
+                add_geoip(entry["rec"], obj["g"])
+            ready.append(entry)
+        except Exception as e:
+            entry.update(error=str(e), attempts=entry["attempts"] + 1)
+            remaining.append(entry)
+
+    # spooled records are sent as is, without heartbeat coalescing
+    for idx, error in obj["sink"].send_batch([x["rec"] for x in ready]):
+        entry = ready[idx]
+        entry.update(error=error, attempts=entry["attempts"] + 1)
+        remaining.append(entry)
+
+    spool.release(remaining)
+    logger.info(
+        "Replayed %d actions, %d failed again",
+        len(entries) - len(remaining),
+        len(remaining),
+    )
+
+
+def fetch_actions(
+    mh,
+    start,
+    end,
+    batch_size,
+    wait,
+    process,
+    counts,
+    lease=None,
+    stream=False,
+    resolve=None,
+):
+    """
+    Pages through the actions from `start` to `end`, passing each one to
+    `process`, and returns the last action. If a `lease` is given each
+    page is only fetched while it's still held. With `stream` each page is
+    decoded into `LeanAction`s as they're processed. If given, `resolve`
+    is called with each run of up to `EPISODE_RESOLVE_BATCH_SIZE` actions
+    before any of them is processed, so a streamed page is never held
+    whole.
+    """
     offset = 0
-    batch_count = 0
-    action_count = 0
-    fail_count = 0
     last_action = None
 
     while True:
 
+        if lease is not None:
+            lease.check()
+
         req_params = {
             "start": start,
             "end": end,
@@ -177,63 +546,316 @@ def useractions(
         }
 
         try:
-            actions = mh.user_actions(**req_params)
+            if stream:
+                actions = iter_user_actions(mh, **req_params)
+            else:
+                actions = iter(mh.user_actions(**req_params))
+            first = next(actions, None)
         except Exception as e:
             logger.error("API request failed: %s", str(e))
             raise
 
-        if len(actions) == 0:
+        if first is None:
             logger.info("No more actions")
             break
 
-        batch_count += 1
-        action_count += len(actions)
-        logger.info("Batch %d: %d actions", batch_count, len(actions))
+        page = chain([first], actions)
+        if resolve is not None:
+            page = resolved_chunks(page, resolve)
 
-        for action in actions:
+        fetched = 0
+        for action in page:
+            fetched += 1
             last_action = action
-            try:
-                rec = create_action_rec(action)
-                if output == "sqs":
-                    queue.send_message(MessageBody=json.dumps(rec))
-                else:
-                    print(json.dumps(rec))
-            except Exception as e:
-                logger.error(
-                    "Exception during rec creation for %s: %s",
-                    action.id,
-                    str(e),
-                )
-                fail_count += 1
-                continue
+            process(action)
+
+        counts["batches"] += 1
+        counts["actions"] += fetched
+        logger.info("Batch %d: %d actions", counts["batches"], fetched)
 
         time.sleep(wait)
         offset += batch_size
 
-    logger.info(
-        "Total actions: %d, total batches: %d, total failed: %d",
-        action_count,
-        batch_count,
-        fail_count,
-        extra={
-            "actions": action_count,
-            "batches": batch_count,
-            "failures": fail_count,
-        },
+    return last_action
+
+
+def resolved_chunks(actions, resolve):
+    while True:
+        chunk = list(islice(actions, EPISODE_RESOLVE_BATCH_SIZE))
+        if not chunk:
+            return
+        resolve(chunk)
+        yield from chunk
+
+
+# the only parts of an action that `create_action_rec` reads
+LEAN_ACTION_FIELDS = (
+    "id",
+    "created",
+    "mediapackageId",
+    "sessionId",
+    "type",
+    "inpoint",
+    "outpoint",
+    "length",
+    "isPlaying",
+)
+LEAN_SESSION_FIELDS = ("sessionId", "userId", "userAgent", "userIp")
+_UNRESOLVED = object()
+
+
+class LeanAction(object):
+    """
+    A useraction reduced to the fields `create_action_rec` reads; a
+    fraction of the size of a pyhorn `UserAction` and the raw response
+    it keeps
+    """
+
+    __slots__ = LEAN_ACTION_FIELDS + ("client", "_episode")
+
+    def __init__(self, data, client):
+        for field in LEAN_ACTION_FIELDS:
+            setattr(self, field, data.get(field))
+        session = self.sessionId or {}
+        self.sessionId = {
+            k: session[k] for k in LEAN_SESSION_FIELDS if k in session
+        }
+        self.client = client
+        self._episode = _UNRESOLVED
+
+    @property
+    def episode(self):
+        if self._episode is _UNRESOLVED:
+            data = SearchEndpoint.episode(
+                self.client, episode_id=self.mediapackageId
+            )
+            self._episode = data and SearchEpisode(data, self.client) or None
+        return self._episode
+
+    @property
+    def _raw(self):
+        return {field: getattr(self, field) for field in LEAN_ACTION_FIELDS}
+
+
+def has_ijson():
+    try:
+        import ijson  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def iter_user_actions(mh, **kwargs):
+    """
+    Yields a page of `mh.user_actions(**kwargs)` as `LeanAction`s. With
+    ijson installed the response is decoded as it's read, so only one
+    action is held in memory at a time; otherwise it's decoded whole.
+    """
+    params = UserTrackingEndpoint.map_kwargs_to_params("user_actions", kwargs)
+    auth = None
+    if mh.user and mh.passwd:
+        auth = HTTPDigestAuth(mh.user, mh.passwd)
+    resp = client.get_session().get(
+        urljoin(mh.base_url, "usertracking/actions.json"),
+        params=params,
+        headers=mh.default_headers.copy(),
+        auth=auth,
+        timeout=mh.timeout,
+        stream=True,
     )
+    with closing(resp):
+        resp.raise_for_status()
+        if has_ijson():
+            # let urllib3 undo any content-encoding while streaming
+            resp.raw.decode_content = True
+            items = stream_action_items(resp.raw)
+        else:
+            items = resp.json()["actions"].get("action", [])
+            if isinstance(items, dict):
+                items = [items]
+        for data in items:
+            yield LeanAction(data, mh)
+
+
+def stream_action_items(fileobj):
+    """
+    Incrementally decodes a user_actions response, yielding each action
+    dict. The api returns a single action as an object rather than a list.
+    """
+    import ijson
+
+    builder = None
+    depth = 0
+    for prefix, event, value in ijson.parse(fileobj, use_float=True):
+        if builder is not None:
+            builder.event(event, value)
+            if event in ("start_map", "start_array"):
+                depth += 1
+            elif event in ("end_map", "end_array"):
+                depth -= 1
+                if depth == 0:
+                    yield builder.value
+                    builder = None
+        elif event == "start_map" and prefix in (
+            "actions.action",
+            "actions.action.item",
+        ):
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+            depth = 1
+
+
+def harvest_windows(
+    mh,
+    start,
+    end,
+    window,
+    lease_ttl,
+    batch_size,
+    wait,
+    process,
+    flush,
+    counts,
+    last_action_ts_key=None,
+    stream=False,
+    resolve=None,
+):
+    """
+    Harvests the complete `window` minute windows between `start` and `end`
+    that no other node has claimed or finished. Windows are aligned to the
+    epoch so every node computes the same ones, and always fetched from
+    their start so a window marked done is never missing actions.
+    Delivery is at-least-once: a window whose lease is lost part way is
+    harvested again in full by the node that takes it over.
+    """
+    for win_start, fetch_start, fetch_end in harvest_window_bounds(
+        start, end, window
+    ):
+        if r.zscore(WINDOWS_DONE_KEY, win_start) is not None:
+            continue
+
+        lease = Lease(r, WINDOW_LEASE_KEY % win_start, lease_ttl)
+        if not lease.acquire():
+            logger.info("Window %s is claimed by another node", fetch_start)
+            continue
+        # another node may have finished it and released its lease since
+        # the check above
+        if r.zscore(WINDOWS_DONE_KEY, win_start) is not None:
+            lease.release()
+            continue
 
-    if update_last_ts:
+        logger.info(
+            "Fetching user actions from %s to %s", fetch_start, fetch_end
+        )
         try:
-            if action_count == 0:
-                last_action_ts = end
-            else:
-                last_action_ts = arrow.get(last_action.created).format(
-                    "YYYYMMDDHHmmss"
+            with lease:
+                fetch_actions(
+                    mh,
+                    fetch_start,
+                    fetch_end,
+                    batch_size,
+                    wait,
+                    process,
+                    counts,
+                    lease=lease,
+                    stream=stream,
+                    resolve=resolve,
                 )
-            set_harvest_ts(last_action_ts_key, last_action_ts)
-            logger.info("Setting last action timestamp to %s", last_action_ts)
-        except Exception as e:
-            logger.error("Failed setting last action timestamp: %s", str(e))
+                flush()
+                lease.check()
+                r.zadd(WINDOWS_DONE_KEY, {win_start: win_start})
+        except LeaseLostError as e:
+            # whoever took over the window harvests all of it again
+            logger.error("Abandoning window %s: %s", fetch_start, str(e))
+            break
+
+        if last_action_ts_key is not None:
+            advance_harvest_ts(last_action_ts_key, window)
+
+
+def harvest_window_bounds(start, end, window):
+    """
+    Yields (window id, start, end) for each complete window overlapping
+    `start` to `end`; the first window may start before `start`
+    """
+    size = window * 60
+    end_ts = arrow.get(end, "YYYYMMDDHHmmss").int_timestamp
+    win_start = arrow.get(
+        window_start(start, window), "YYYYMMDDHHmmss"
+    ).int_timestamp
+    # the api's start and end are inclusive
+    while win_start + size - 1 <= end_ts:
+        yield (
+            win_start,
+            format_harvest_ts(win_start),
+            format_harvest_ts(win_start + size - 1),
+        )
+        win_start += size
+
+
+def window_start(timestamp, window):
+    """
+    Returns the start of the `window` minute window `timestamp` is in
+    """
+    size = window * 60
+    ts = arrow.get(timestamp, "YYYYMMDDHHmmss").int_timestamp
+    return format_harvest_ts(ts - ts % size)
+
+
+def format_harvest_ts(timestamp):
+    return arrow.get(timestamp).format("YYYYMMDDHHmmss")
+
+
+def seed_harvest_ts(ts_key, timestamp):
+    """
+    Sets the last harvested timestamp to `timestamp` unless some node has
+    set it already, and returns the timestamp that's set
+    """
+    lease = Lease(r, WATERMARK_LEASE_KEY, WATERMARK_LEASE_TTL)
+    if not lease.acquire():
+        # another node is seeding or advancing it
+        return timestamp
+    try:
+        current = get_harvest_ts(ts_key)
+        if current is not None:
+            return current
+        set_harvest_ts(ts_key, timestamp)
+        logger.info("Setting last action timestamp to %s", timestamp)
+        return timestamp
+    finally:
+        lease.release()
+
+
+def advance_harvest_ts(ts_key, window):
+    """
+    Moves the last harvested timestamp to the start of the first window
+    after it that isn't done, so it never skips a window another node is
+    still working on
+    """
+    lease = Lease(r, WATERMARK_LEASE_KEY, WATERMARK_LEASE_TTL)
+    if not lease.acquire():
+        # another node is advancing it
+        return
+    try:
+        current = get_harvest_ts(ts_key)
+        if current is None:
+            return
+        size = window * 60
+        current_ts = arrow.get(current, "YYYYMMDDHHmmss").int_timestamp
+        win_start = current_ts - current_ts % size
+        while r.zscore(WINDOWS_DONE_KEY, win_start) is not None:
+            win_start += size
+        if win_start > current_ts:
+            set_harvest_ts(ts_key, format_harvest_ts(win_start))
+            logger.info(
+                "Setting last action timestamp to %s",
+                format_harvest_ts(win_start),
+            )
+        r.zremrangebyscore(
+            WINDOWS_DONE_KEY, "-inf", win_start - WINDOWS_DONE_RETENTION
+        )
+    finally:
+        lease.release()
 
 
 def create_action_rec(action):
@@ -320,7 +942,120 @@ def create_action_rec(action):
     return rec
 
 
+class HeartbeatCoalescer(object):
+    """
+    Merges consecutive heartbeat records of the same (session_id, mpid,
+    is_playing) into HEARTBEAT_SPAN records; see the README for the span
+    schema. `add` returns the records that are ready to be sent: any other
+    action is returned unchanged, after the spans of its session have been
+    closed so a seek or pause never ends up inside a span.
+    """
+
+    def __init__(self, max_gap=DEFAULT_MAX_HEARTBEAT_GAP):
+        self.max_gap = max_gap
+        # open spans, least recently extended first
+        self.open_spans = OrderedDict()
+        self.heartbeats = 0
+        self.spans = 0
+
+    def add(self, rec):
+        ts = arrow.get(rec["timestamp"]).float_timestamp
+        ready = self.expire(ts)
+
+        if rec["action"]["type"] != "HEARTBEAT":
+            for key in list(self.open_spans):
+                if key[:2] == (rec["session_id"], rec["mpid"]):
+                    ready.append(self.close(key))
+            ready.append(rec)
+            return ready
+
+        self.heartbeats += 1
+        key = (rec["session_id"], rec["mpid"], rec["action"]["is_playing"])
+        span = self.open_spans.get(key)
+        if span is not None and not self.continues(span, rec, ts):
+            ready.append(self.close(key))
+            span = None
+
+        if span is None:
+            span = dict(rec)
+            span["action"] = dict(rec["action"], type=HEARTBEAT_SPAN_TYPE)
+            span["span"] = {
+                "start": rec["timestamp"],
+                "end": rec["timestamp"],
+                "start_inpoint": rec["action"]["inpoint"],
+                "end_inpoint": rec["action"]["inpoint"],
+                "count": 0,
+                "last_action_id": rec["action_id"],
+            }
+            self.open_spans[key] = span
+        else:
+            self.open_spans.move_to_end(key)
+
+        span["span"].update(
+            end=rec["timestamp"],
+            end_inpoint=rec["action"]["inpoint"],
+            last_action_id=rec["action_id"],
+            count=span["span"]["count"] + 1,
+        )
+        span["action"]["outpoint"] = span_outpoint(rec["action"])
+        span["_ts"] = ts
+        return ready
+
+    def continues(self, span, rec, ts):
+        elapsed = ts - span["_ts"]
+        if elapsed > self.max_gap:
+            return False
+        try:
+            moved = int(rec["action"]["inpoint"]) - int(
+                span["span"]["end_inpoint"]
+            )
+        except (TypeError, ValueError):
+            return True
+        # the playhead moved backwards or further than the wall clock did
+        return 0 <= moved <= elapsed + self.max_gap
+
+    def expire(self, now):
+        ready = []
+        while self.open_spans:
+            key, span = next(iter(self.open_spans.items()))
+            if now - span["_ts"] <= self.max_gap:
+                break
+            ready.append(self.close(key))
+        return ready
+
+    def close(self, key):
+        span = self.open_spans.pop(key)
+        del span["_ts"]
+        self.spans += 1
+        return span
+
+    def flush(self):
+        return [self.close(key) for key in list(self.open_spans)]
+
+
+# where a heartbeat's playback coverage ends; heartbeats usually report
+# the same in and outpoint
+def span_outpoint(action):
+    try:
+        if int(action["outpoint"]) > int(action["inpoint"]):
+            return action["outpoint"]
+    except (TypeError, ValueError):
+        pass
+    return action["inpoint"]
+
+
+def add_geoip(rec, g):
+    try:
+        rec["geoip"] = g.get(rec["ip"])
+    except ValueError:
+        logger.debug("Not geolocating invalid ip '%s'", rec["ip"])
+
+
 def get_episode(action):
+    episode = stashed_episode(action)
+    if episode is not _UNRESOLVED:
+        return episode
+
     cached_ep = r.get(action.mediapackageId)
     if cached_ep is not None:
         logger.debug("episode cache hit for %s", action.mediapackageId)
@@ -330,7 +1065,7 @@ def get_episode(action):
         episode = SearchEpisode(episode_data, action.client)
         # make sure anything else that might access the action.episode property
         # gets our cached version
-        action._property_stash["episode"] = episode
+        stash_episode(action, episode)
     else:
         logger.debug("episode cache miss for %s", action.mediapackageId)
         episode = action.episode
@@ -342,6 +1077,108 @@ def get_episode(action):
     return episode
 
 
+def stashed_episode(action):
+    if isinstance(action, LeanAction):
+        return action._episode
+    return action._property_stash.get("episode", _UNRESOLVED)
+
+
+def stash_episode(action, episode):
+    if isinstance(action, LeanAction):
+        action._episode = episode
+    else:
+        action._property_stash["episode"] = episode
+
+
+class EpisodeResolver(object):
+    """
+    Resolves the episodes of a batch of actions before their records are
+    built. Cached episodes are read with a single redis `mget` and the
+    rest are fetched concurrently, at most `per_host` at a time from any
+    one engage host. Episodes that can't be resolved, including any
+    whose redis lookup fails, are left for `get_episode`.
+    """
+
+    def __init__(
+        self,
+        concurrency=DEFAULT_EPISODE_CONCURRENCY,
+        per_host=DEFAULT_EPISODE_HOST_CONCURRENCY,
+    ):
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.per_host = per_host
+        self.host_limits = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.fetched = 0
+        self.failed = 0
+
+    def host_limit(self, mh):
+        host = urlparse(mh.base_url).netloc
+        with self.lock:
+            if host not in self.host_limits:
+                self.host_limits[host] = threading.BoundedSemaphore(
+                    self.per_host
+                )
+            return self.host_limits[host]
+
+    def fetch(self, mh, mpid):
+        with self.host_limit(mh):
+            return SearchEndpoint.episode(mh, episode_id=mpid)
+
+    def resolve(self, actions):
+        by_mpid = OrderedDict()
+        for action in actions:
+            if action.mediapackageId is None:
+                continue
+            if stashed_episode(action) is _UNRESOLVED:
+                by_mpid.setdefault(action.mediapackageId, []).append(action)
+        if not by_mpid:
+            return
+
+        try:
+            cached_eps = r.mget(list(by_mpid))
+        except redis.RedisError as e:
+            logger.warning("Episode cache lookup failed: %s", e)
+            return
+
+        found = {}
+        futures = {}
+        for mpid, cached_ep in zip(by_mpid, cached_eps):
+            if cached_ep is not None:
+                found[mpid] = json.loads(cached_ep.decode("utf-8"))
+                found[mpid]["__from_cache"] = True
+            else:
+                mh = by_mpid[mpid][0].client
+                futures[mpid] = self.executor.submit(self.fetch, mh, mpid)
+        self.hits += len(found)
+
+        pipe = r.pipeline(transaction=False)
+        for mpid, future in futures.items():
+            try:
+                episode_data = future.result()
+            except Exception as e:
+                logger.warning("Failed fetching episode %s: %s", mpid, e)
+                self.failed += 1
+                continue
+            if episode_data is None:
+                continue
+            self.fetched += 1
+            found[mpid] = episode_data
+            pipe.setex(mpid, EPISODE_CACHE_EXPIRE, json.dumps(episode_data))
+        try:
+            pipe.execute()
+        except redis.RedisError as e:
+            logger.warning("Failed caching fetched episodes: %s", e)
+
+        for mpid, episode_data in found.items():
+            episode = SearchEpisode(episode_data, by_mpid[mpid][0].client)
+            for action in by_mpid[mpid]:
+                stash_episode(action, episode)
+
+    def close(self):
+        self.executor.shutdown()
+
+
 @cli.command()
 @click.option(
     "-A",
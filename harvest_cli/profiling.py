@@ -0,0 +1,216 @@
+import sys
+import logging
+import threading
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+PROFILE_MODES = ["cprofile", "sampling", "memory"]
+
+DEFAULT_OUTPUT = {
+    "cprofile": "harvest.prof",
+    "sampling": "harvest.stacks",
+    "memory": "harvest.tracemalloc",
+}
+DEFAULT_TOP = 20
+SAMPLE_INTERVAL = 0.005
+# frames kept per tracemalloc traceback
+MEMORY_FRAMES = 25
+MEMORY_POLL_INTERVAL = 0.5
+PEAK_GROWTH = 1.05
+
+
+def start_profiler(mode, output=None, top=DEFAULT_TOP):
+    """
+    Starts profiling the process; call `stop()` on the returned profiler
+    to write the profile to `output` and log a summary of the top `top`
+    entries
+    """
+    output = output or DEFAULT_OUTPUT[mode]
+    profiler = {
+        "cprofile": CProfiler,
+        "sampling": SamplingProfiler,
+        "memory": MemoryProfiler,
+    }[mode](output, top)
+    logger.info("Profiling with %s; writing the profile to %s", mode, output)
+    profiler.start()
+    return profiler
+
+
+class CProfiler(object):
+    """
+    Deterministic profile of the main thread; the output file can be read
+    with `pstats` or e.g. snakeviz
+    """
+
+    def __init__(self, output, top):
+        import cProfile
+
+        self.output = output
+        self.top = top
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        import io
+        import pstats
+
+        self.profile.disable()
+        self.profile.dump_stats(self.output)
+        summary = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=summary)
+        stats.sort_stats("cumulative").print_stats(self.top)
+        logger.info(
+            "Top %d functions by cumulative time:\n%s",
+            self.top,
+            summary.getvalue(),
+        )
+
+
+class SamplingProfiler(object):
+    """
+    Samples the stacks of every thread every `interval` seconds. Cheap
+    enough to leave on for a whole production run, and unlike cProfile it
+    sees worker threads. The output has one "frame;frame;... count" line
+    per distinct stack, as used by flamegraph tools.
+    """
+
+    def __init__(self, output, top, interval=SAMPLE_INTERVAL):
+        self.output = output
+        self.top = top
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        "%s (%s:%d)"
+                        % (code.co_name, code.co_filename, code.co_firstlineno)
+                    )
+                    frame = frame.f_back
+                self.stacks[tuple(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+        with open(self.output, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write("%s %d\n" % (";".join(stack), count))
+
+        own = Counter()
+        total = Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for func in set(stack):
+                total[func] += count
+
+        thread_samples = sum(self.stacks.values()) or 1
+        lines = ["%8s %8s  function" % ("own%", "total%")]
+        for func, count in own.most_common(self.top):
+            lines.append(
+                "%7.1f%% %7.1f%%  %s"
+                % (
+                    100.0 * count / thread_samples,
+                    100.0 * total[func] / thread_samples,
+                    func,
+                )
+            )
+        logger.info(
+            "%d samples; top %d functions by own time:\n%s",
+            self.samples,
+            self.top,
+            "\n".join(lines),
+        )
+
+
+class MemoryProfiler(object):
+    """
+    Traces allocations with tracemalloc and reports the call sites holding
+    the most memory at the peak of the run. The snapshot is retaken each
+    time traced memory grows by `PEAK_GROWTH` over the last one, so it's
+    within that much of the true peak. The output is that snapshot; see
+    `tracemalloc.Snapshot.load`.
+    """
+
+    def __init__(self, output, top, interval=MEMORY_POLL_INTERVAL):
+        self.output = output
+        self.top = top
+        self.interval = interval
+        self.peak_snapshot = None
+        self.peak_size = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        import tracemalloc
+
+        tracemalloc.start(MEMORY_FRAMES)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.check_peak()
+
+    def check_peak(self):
+        import tracemalloc
+
+        current, peak = tracemalloc.get_traced_memory()
+        if current > self.peak_size * PEAK_GROWTH:
+            self.peak_snapshot = tracemalloc.take_snapshot()
+            self.peak_size = current
+
+    def stop(self):
+        import tracemalloc
+
+        self._stop.set()
+        self._thread.join()
+        self.check_peak()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        snapshot = self.peak_snapshot.filter_traces(
+            [
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            ]
+        )
+        snapshot.dump(self.output)
+
+        lines = []
+        for stat in snapshot.statistics("lineno")[: self.top]:
+            frame = stat.traceback[0]
+            lines.append(
+                "%10.1f KiB %8d blocks  %s:%d"
+                % (
+                    stat.size / 1024.0,
+                    stat.count,
+                    frame.filename,
+                    frame.lineno,
+                )
+            )
+        logger.info(
+            "Peak traced memory %.1f MiB, %.1f MiB at exit; top %d "
+            "allocation sites at %.1f MiB:\n%s",
+            peak / 1024.0 / 1024.0,
+            current / 1024.0 / 1024.0,
+            self.top,
+            self.peak_size / 1024.0 / 1024.0,
+            "\n".join(lines),
+        )
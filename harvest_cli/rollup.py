@@ -0,0 +1,329 @@
+import click
+import arrow
+import logging
+from elasticsearch_dsl import Search, Q
+
+from harvest_cli import cli
+from .elastic import bulk_index
+from .utils import (
+    es_connection,
+    get_mpids_from_useractions,
+    chunks,
+    msearch,
+    heartbeat_span_buckets,
+    PAELLA_EVENT_FILTERS,
+)
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_INDEX = "useraction-rollups"
+
+# heartbeat buckets are stored at this resolution in seconds; attendance
+# can be computed from the rollups for any chunk interval that's a multiple
+DEFAULT_RESOLUTION = 60
+
+
+@cli.command()
+@click.option(
+    "--date",
+    help="day of useractions to roll up, e.g. YYYY-mm-dd; "
+    "defaults to yesterday",
+)
+@click.option(
+    "-e",
+    "--es-host",
+    envvar="ES_HOST",
+    help="Elasticsearch host:port",
+    default="localhost:9200",
+)
+@click.option(
+    "--resolution",
+    default=DEFAULT_RESOLUTION,
+    help="heartbeat bucket size in seconds",
+)
+@click.option(
+    "--batch-size",
+    default=50,
+    help="number of episode searches sent per msearch request",
+)
+@click.option(
+    "--force",
+    is_flag=True,
+    help="roll up the day again even if it has been rolled up before, "
+    "replacing its earlier counts",
+)
+def rollup(date, es_host, resolution, batch_size, force):
+    """
+    Add a day of useractions to the per (mpid, huid, is_live) rollups
+    """
+    if date is None:
+        date = arrow.now().shift(days=-1).format("YYYY-MM-DD")
+    day = date.replace("-", ".")
+
+    es = es_connection(es_host)
+
+    state = es.get(index=ROLLUP_INDEX, doc_type="state", id=day, ignore=404)
+    if state.get("found") and not force:
+        logger.info("useractions for %s have already been rolled up", date)
+        return
+
+    source_index = "useractions*-%s" % day
+    mpids = get_mpids_from_useractions(es, source_index)
+    logger.info("Rolling up %d episodes from %s", len(mpids), source_index)
+
+    doc_count = 0
+    updated = set()
+    failed = []
+    for batch in chunks(mpids, batch_size):
+        searches = [
+            rollup_search(mpid, resolution).to_dict() for mpid in batch
+        ]
+        spans = heartbeat_span_buckets(es, source_index, batch, resolution)
+        daily = {}
+        for mpid, res in zip(batch, msearch(es, source_index, searches)):
+            if "error" in res:
+                logger.error(
+                    "Search failed for mpid %s: %s", mpid, res["error"]
+                )
+                failed.append(mpid)
+                continue
+            daily.update(
+                rollup_docs(mpid, res, day, resolution, spans.get(mpid, {}))
+            )
+
+        docs = merge_rollups(es, daily, day, replace=force)
+        bulk_index(
+            es,
+            [
+                dict(
+                    _index=ROLLUP_INDEX,
+                    _type="rollup",
+                    _id=doc_id,
+                    _source=doc,
+                )
+                for doc_id, doc in docs.items()
+            ],
+        )
+        doc_count += len(docs)
+        updated.update(docs)
+
+    if failed:
+        # without the state document the next run retries the day; rollups
+        # that already have it are skipped
+        raise click.ClickException(
+            "Search failed for %d of %d episodes; %s was not marked as "
+            "rolled up, re-run to retry" % (len(failed), len(mpids), date)
+        )
+
+    if force:
+        removed = remove_day(es, day, updated)
+        logger.info("Removed %s from %d stale rollups", date, removed)
+
+    es.index(
+        index=ROLLUP_INDEX,
+        doc_type="state",
+        id=day,
+        body={"day": day, "rolled_up": str(arrow.utcnow())},
+    )
+    logger.info("Updated %d rollups for %s", doc_count, date)
+
+
+def rollup_search(mpid, resolution):
+    s = Search().extra(size=0)
+    s = s.filter(Q("term", mpid=mpid) & ~Q("term", huid="anonymous"))
+    s.aggs.bucket("huid", "terms", field="huid", size=0).bucket(
+        "is_live", "terms", field="is_live", size=0
+    )
+    s.aggs["huid"]["is_live"].bucket(
+        "paella_events", "filters", filters=PAELLA_EVENT_FILTERS
+    )
+    s.aggs["huid"]["is_live"].bucket(
+        "heartbeats",
+        "filter",
+        Q("term", **{"action.is_playing": True})
+        & Q("term", **{"action.type": "HEARTBEAT"}),
+    ).bucket(
+        "inpoints",
+        "histogram",
+        field="action.inpoint",
+        interval=str(resolution),
+        min_doc_count=1,
+    )
+    return s
+
+
+def rollup_id(mpid, huid, is_live):
+    return "%s:%s:%d" % (mpid, huid, is_live)
+
+
+# `spans` are the episode's heartbeat span buckets from
+# `heartbeat_span_buckets`, keyed by (huid, is_live)
+def rollup_docs(mpid, res, day, resolution, spans):
+    docs = {}
+    for huid_bucket in res["aggregations"]["huid"]["buckets"]:
+        huid = huid_bucket["key"]
+        for live_bucket in huid_bucket["is_live"]["buckets"]:
+            # is_live is mapped as a boolean, so keys come back as 0/1
+            is_live = int(live_bucket["key"])
+            heartbeat_buckets = set(
+                int(x["key"])
+                for x in live_bucket["heartbeats"]["inpoints"]["buckets"]
+            )
+            heartbeat_buckets |= spans.get((huid, is_live), (set(), 0))[0]
+            contribution = {
+                "days": [day],
+                "heartbeat_buckets": sorted(heartbeat_buckets),
+            }
+            event_buckets = live_bucket["paella_events"]["buckets"]
+            for event_type, stats in event_buckets.items():
+                contribution[event_type] = stats["doc_count"]
+            doc = {
+                "mpid": mpid,
+                "huid": huid,
+                "is_live": is_live,
+                "resolution": resolution,
+            }
+            docs[rollup_id(mpid, huid, is_live)] = apply_contributions(
+                doc, [contribution]
+            )
+    return docs
+
+
+# each rollup keeps the counts contributed by each day so that a day can be
+# replaced; the totals are recomputed from them
+def apply_contributions(doc, contributions):
+    doc["contributions"] = contributions
+    doc["days"] = sorted(set(d for c in contributions for d in c["days"]))
+    doc["heartbeat_buckets"] = sorted(
+        set(x for c in contributions for x in c["heartbeat_buckets"])
+    )
+    for event_type in PAELLA_EVENT_FILTERS:
+        doc[event_type] = sum(c.get(event_type, 0) for c in contributions)
+    return doc
+
+
+def rollup_contributions(doc):
+    if "contributions" in doc:
+        return doc["contributions"]
+    # rollups merged before contributions were kept have a single one
+    contribution = {
+        "days": doc["days"],
+        "heartbeat_buckets": doc["heartbeat_buckets"],
+    }
+    for event_type in PAELLA_EVENT_FILTERS:
+        contribution[event_type] = doc.get(event_type, 0)
+    return [contribution]
+
+
+def without_day(doc_id, contributions, day):
+    kept = []
+    for contribution in contributions:
+        if day not in contribution["days"]:
+            kept.append(contribution)
+        elif len(contribution["days"]) > 1:
+            raise click.ClickException(
+                "Can't replace %s in rollup %s; its days were merged before "
+                "per-day counts were kept" % (day, doc_id)
+            )
+    return kept
+
+
+# merge a day's rollups into whatever is already indexed for the same keys;
+# with `replace` counts merged for the same day before are replaced
+def merge_rollups(es, daily, day, replace=False):
+    if len(daily) == 0:
+        return {}
+
+    existing = es.mget(
+        index=ROLLUP_INDEX,
+        doc_type="rollup",
+        body={"ids": list(daily.keys())},
+    )
+
+    merged = {}
+    for hit in existing["docs"]:
+        doc = daily[hit["_id"]]
+        if hit.get("found"):
+            prev = hit["_source"]
+            if day in prev.get("days", []) and not replace:
+                # merged by an earlier, interrupted run for the same day
+                continue
+            if prev.get("resolution") != doc["resolution"]:
+                raise click.ClickException(
+                    "Rollup resolution mismatch for %s: %s != %s"
+                    % (hit["_id"], prev.get("resolution"), doc["resolution"])
+                )
+            contributions = without_day(
+                hit["_id"], rollup_contributions(prev), day
+            )
+            apply_contributions(doc, contributions + doc["contributions"])
+        doc["updated"] = str(arrow.utcnow())
+        merged[hit["_id"]] = doc
+
+    return merged
+
+
+def remove_day(es, day, updated):
+    """
+    Takes `day` out of the rollups it was merged into that got no counts
+    for it this time, other than those in `updated`, and returns how many
+    were changed
+    """
+    s = Search(using=es, index=ROLLUP_INDEX, doc_type="rollup")
+    s = s.filter(Q("term", days=day))
+    actions = []
+    for hit in s.scan():
+        if hit.meta.id in updated:
+            continue
+        doc = hit.to_dict()
+        contributions = without_day(
+            hit.meta.id, rollup_contributions(doc), day
+        )
+        action = dict(_index=ROLLUP_INDEX, _type="rollup", _id=hit.meta.id)
+        if contributions:
+            action["_source"] = apply_contributions(doc, contributions)
+            action["_source"]["updated"] = str(arrow.utcnow())
+        else:
+            action["_op_type"] = "delete"
+        actions.append(action)
+    bulk_index(es, actions)
+    return len(actions)
+
+
+def scan_rollups(es, mpids, **filters):
+    s = Search(using=es, index=ROLLUP_INDEX, doc_type="rollup")
+    s = s.filter(Q("terms", mpid=mpids))
+    for field, value in filters.items():
+        s = s.filter(Q("term", **{field: value}))
+    for hit in s.scan():
+        yield hit.to_dict()
+
+
+# viewing option counters per huid, summed over live and vod
+def rollup_viewing_options(es, mpids):
+    counts = dict((mpid, {}) for mpid in mpids)
+    for doc in scan_rollups(es, mpids):
+        huids = counts[doc["mpid"]]
+        row = huids.setdefault(
+            doc["huid"], dict((x, 0) for x in PAELLA_EVENT_FILTERS)
+        )
+        for event_type in PAELLA_EVENT_FILTERS:
+            row[event_type] += doc.get(event_type, 0)
+    return counts
+
+
+# number of distinct `chunk_interval` chunks with heartbeats, per huid
+def rollup_attendance(es, mpids, live, chunk_interval):
+    chunks_watched = dict((mpid, {}) for mpid in mpids)
+    for doc in scan_rollups(es, mpids, is_live=int(live)):
+        if chunk_interval % doc["resolution"] != 0:
+            raise click.ClickException(
+                "--chunk-interval must be a multiple of the rollup "
+                "resolution (%ds)" % doc["resolution"]
+            )
+        if len(doc["heartbeat_buckets"]) == 0:
+            continue
+        chunks_watched[doc["mpid"]][doc["huid"]] = len(
+            set(x // chunk_interval for x in doc["heartbeat_buckets"])
+        )
+    return chunks_watched
@@ -1,6 +1,10 @@
 import os
+import json
 import click
-from os.path import join, dirname, splitext
+import logging
+from fnmatch import fnmatch
+from contextlib import contextmanager
+from os.path import join, dirname, splitext, exists
 
 from harvest_cli import cli
 from .utils import es_connection
@@ -8,6 +12,21 @@ from .utils import es_connection
 BASE_PATH = dirname(dirname(__file__))
 INDEX_TEMPLATE_DIR = join(BASE_PATH, "index_templates")
 
+logger = logging.getLogger(__name__)
+
+BULK_MODE_PATTERNS = ["useractions-*", "sessions-*", "meetings-*"]
+BULK_MODE_STATE_FILE = ".bulk_mode.json"
+BULK_MODE_SETTINGS = {
+    "index.refresh_interval": "-1",
+    "index.number_of_replicas": "0",
+}
+# elasticsearch's own defaults, for settings neither an index nor any of
+# the index templates set explicitly
+DEFAULT_INDEX_SETTINGS = {
+    "index.refresh_interval": "1s",
+    "index.number_of_replicas": "1",
+}
+
 
 @cli.group()
 def setup():
@@ -26,3 +45,177 @@ def load_index_templates(es_host):
         template_name, ext = splitext(t)
         with open(file_path, "rb") as f:
             es.indices.put_template(name=template_name, body=f.read())
+
+
+@setup.command()
+@click.argument("state", type=click.Choice(["on", "off"]))
+@click.option("--es-host", envvar="ES_HOST")
+@click.option(
+    "--pattern",
+    "patterns",
+    multiple=True,
+    help="index pattern to switch; may be repeated; defaults to %s"
+    % ", ".join(BULK_MODE_PATTERNS),
+)
+@click.option(
+    "--state-file",
+    envvar="BULK_MODE_STATE_FILE",
+    default=BULK_MODE_STATE_FILE,
+    help="where the settings to restore are kept while bulk mode is on",
+)
+@click.option(
+    "--forcemerge",
+    is_flag=True,
+    help="force merge the indices after switching bulk mode off",
+)
+@click.option(
+    "--max-num-segments",
+    default=1,
+    help="segments per shard to force merge down to",
+)
+def bulk_mode(
+    state, es_host, patterns, state_file, forcemerge, max_num_segments
+):
+    """
+    Disable refreshes and replicas on the harvest indices while backfilling
+    """
+    es = es_connection(es_host)
+    if state == "on":
+        enable_bulk_mode(es, list(patterns) or BULK_MODE_PATTERNS, state_file)
+    else:
+        if patterns:
+            logger.warning("--pattern is ignored; restoring saved patterns")
+        disable_bulk_mode(es, state_file, forcemerge, max_num_segments)
+
+
+def bulk_mode_template_name(pattern):
+    return "bulk_mode_" + pattern.replace("*", "").strip("-_.")
+
+
+def load_bulk_mode_state(state_file):
+    if not exists(state_file):
+        return None
+    with open(state_file) as f:
+        return json.load(f)
+
+
+def enable_bulk_mode(es, patterns, state_file):
+    """
+    Saves the current refresh interval and replica count of the indices
+    matching `patterns`, then disables both. Indices created while bulk
+    mode is on get the same settings via a high order index template.
+    """
+    state = load_bulk_mode_state(state_file) or {"patterns": [], "indices": {}}
+    current = es.indices.get_settings(
+        index=",".join(patterns), flat_settings=True
+    )
+    for index, res in current.items():
+        # keep the settings saved by an earlier `on`, not bulk mode's own
+        if index not in state["indices"]:
+            state["indices"][index] = dict(
+                (name, res["settings"].get(name))
+                for name in BULK_MODE_SETTINGS
+            )
+    state["patterns"] = sorted(set(state["patterns"]) | set(patterns))
+
+    tmp_path = state_file + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, state_file)
+
+    for pattern in patterns:
+        es.indices.put_template(
+            name=bulk_mode_template_name(pattern),
+            body={
+                "template": pattern,
+                "order": 100,
+                "settings": BULK_MODE_SETTINGS,
+            },
+        )
+    if current:
+        es.indices.put_settings(
+            index=",".join(current.keys()), body=BULK_MODE_SETTINGS
+        )
+    logger.info(
+        "Bulk mode on for %d indices matching %s",
+        len(current),
+        ", ".join(patterns),
+    )
+
+
+def disable_bulk_mode(es, state_file, forcemerge=False, max_num_segments=1):
+    """
+    Restores the settings saved by `enable_bulk_mode`, then refreshes and
+    optionally force merges the indices
+    """
+    state = load_bulk_mode_state(state_file)
+    if state is None:
+        logger.warning("Bulk mode is not on; %s not found", state_file)
+        return
+
+    patterns = state["patterns"]
+    for pattern in patterns:
+        es.indices.delete_template(
+            name=bulk_mode_template_name(pattern), ignore=404
+        )
+
+    templates = es.indices.get_template(flat_settings=True)
+    current = es.indices.get_settings(
+        index=",".join(patterns), flat_settings=True
+    )
+    for index in current:
+        saved = state["indices"].get(index)
+        if saved is None:
+            # created while bulk mode was on
+            saved = template_settings(templates, index)
+        settings = dict(
+            (name, saved.get(name) or DEFAULT_INDEX_SETTINGS[name])
+            for name in BULK_MODE_SETTINGS
+        )
+        es.indices.put_settings(index=index, body=settings)
+
+    if current:
+        indices = ",".join(current.keys())
+        es.indices.refresh(index=indices)
+        if forcemerge:
+            logger.info("Force merging %d indices", len(current))
+            es.indices.forcemerge(
+                index=indices, max_num_segments=max_num_segments
+            )
+
+    os.remove(state_file)
+    logger.info(
+        "Bulk mode off for %d indices matching %s",
+        len(current),
+        ", ".join(patterns),
+    )
+
+
+# the settings the index templates give a new index with this name
+def template_settings(templates, index):
+    matching = sorted(
+        (t for t in templates.values() if fnmatch(index, t["template"])),
+        key=lambda t: t.get("order", 0),
+    )
+    settings = {}
+    for t in matching:
+        settings.update(t.get("settings", {}))
+    return settings
+
+
+@contextmanager
+def bulk_loading(es, patterns, state_file=BULK_MODE_STATE_FILE, **kwargs):
+    """
+    Turns bulk mode on for the duration of the block, unless it's already
+    on, in which case whoever turned it on is left to turn it off
+    """
+    if load_bulk_mode_state(state_file) is not None:
+        logger.info("Bulk mode is already on")
+        yield
+        return
+
+    enable_bulk_mode(es, patterns, state_file)
+    try:
+        yield
+    finally:
+        disable_bulk_mode(es, state_file, **kwargs)
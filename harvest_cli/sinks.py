@@ -0,0 +1,259 @@
+import os
+import json
+import zlib
+import fcntl
+import base64
+import arrow
+import logging
+import threading
+
+from .utils import chunks
+
+logger = logging.getLogger(__name__)
+
+# max entries per sqs send_message_batch request
+SQS_BATCH_SIZE = 10
+
+PACKED_FORMAT = "harvest-packed"
+PACKED_VERSION = 1
+# sqs allows 256KiB per message, including attributes
+PACKED_MAX_BYTES = 250000
+# room for the header line
+PACKED_HEADER_BYTES = 200
+
+
+class SinkError(Exception):
+    """
+    Raised when buffered records, `recs`, couldn't be sent
+    """
+
+    def __init__(self, message, recs):
+        super().__init__(message)
+        self.recs = recs
+
+
+class StdoutSink(object):
+    def send(self, rec):
+        print(json.dumps(rec))
+
+    def flush(self):
+        pass
+
+    def send_batch(self, recs):
+        for rec in recs:
+            self.send(rec)
+        return []
+
+
+class SqsSink(object):
+    def __init__(self, queue):
+        self.queue = queue
+
+    def send(self, rec):
+        self.queue.send_message(MessageBody=json.dumps(rec))
+
+    def flush(self):
+        pass
+
+    def send_batch(self, recs):
+        """
+        Sends `recs` in batches of up to 10 messages and returns a list of
+        (index, error) for the ones that weren't delivered
+        """
+        failed = []
+        for offset, batch in enumerate_chunks(recs, SQS_BATCH_SIZE):
+            entries = [
+                {"Id": str(offset + i), "MessageBody": json.dumps(rec)}
+                for i, rec in enumerate(batch)
+            ]
+            try:
+                resp = self.queue.send_messages(Entries=entries)
+            except Exception as e:
+                failed.extend((offset + i, str(e)) for i in range(len(batch)))
+                continue
+            for entry in resp.get("Failed", []):
+                failed.append((int(entry["Id"]), entry.get("Message")))
+        return failed
+
+
+class PackedSqsSink(object):
+    """
+    Packs many records into each sqs message as zlib compressed,
+    base64 encoded NDJSON below a json header line, filling each message
+    up to `max_bytes`. Use `unpack_message` to read them.
+    """
+
+    def __init__(self, queue, max_bytes=PACKED_MAX_BYTES):
+        self.queue = queue
+        self.max_bytes = max_bytes
+        self.reset()
+
+    def reset(self):
+        self.compressor = zlib.compressobj()
+        self.chunks = []
+        self.compressed_bytes = 0
+        self.recs = []
+
+    def fits(self, line_bytes):
+        # deflate's worst case is the input plus 5 bytes per 16KB block;
+        # checking before each record means a message never has to be
+        # split after the fact
+        worst = (
+            self.compressed_bytes + line_bytes + 5 * (line_bytes // 16384 + 2)
+        )
+        encoded = (worst + 2) // 3 * 4
+        return PACKED_HEADER_BYTES + encoded <= self.max_bytes
+
+    def send(self, rec):
+        line = (json.dumps(rec) + "\n").encode("utf-8")
+        failed = None
+        if self.recs and not self.fits(len(line)):
+            try:
+                self.flush()
+            except SinkError as e:
+                failed = e
+        # a sync flush after each record makes the compressed size exact
+        data = self.compressor.compress(line) + self.compressor.flush(
+            zlib.Z_SYNC_FLUSH
+        )
+        self.chunks.append(data)
+        self.compressed_bytes += len(data)
+        self.recs.append(rec)
+        if failed is not None:
+            raise failed
+
+    def flush(self):
+        if not self.recs:
+            return
+        self.chunks.append(self.compressor.flush())
+        header = {
+            "format": PACKED_FORMAT,
+            "version": PACKED_VERSION,
+            "count": len(self.recs),
+            "encoding": "zlib+base64",
+        }
+        body = "%s\n%s" % (
+            json.dumps(header),
+            base64.b64encode(b"".join(self.chunks)).decode("ascii"),
+        )
+        recs = self.recs
+        self.reset()
+        try:
+            self.queue.send_message(MessageBody=body)
+        except Exception as e:
+            raise SinkError(str(e), recs)
+
+    def send_batch(self, recs):
+        """
+        Sends `recs` packed and returns a list of (index, error) for the
+        ones that weren't delivered
+        """
+        failed = []
+        indexes = {}
+        for idx, rec in enumerate(recs):
+            indexes[id(rec)] = idx
+            try:
+                self.send(rec)
+            except SinkError as e:
+                failed.extend((indexes[id(x)], str(e)) for x in e.recs)
+        try:
+            self.flush()
+        except SinkError as e:
+            failed.extend((indexes[id(x)], str(e)) for x in e.recs)
+        return failed
+
+
+def unpack_message(body):
+    """
+    Returns the records in an sqs message body sent by `useractions`,
+    packed or not
+    """
+    header, _, payload = body.partition("\n")
+    meta = json.loads(header)
+    if meta.get("format") != PACKED_FORMAT:
+        # a single unpacked record
+        return [meta]
+    if meta["version"] != PACKED_VERSION:
+        raise ValueError(
+            "Unsupported packed message version %s" % meta["version"]
+        )
+    data = zlib.decompress(base64.b64decode(payload)).decode("utf-8")
+    recs = [json.loads(line) for line in data.splitlines() if line]
+    if len(recs) != meta["count"]:
+        raise ValueError(
+            "Packed message has %d records, header says %d"
+            % (len(recs), meta["count"])
+        )
+    return recs
+
+
+def enumerate_chunks(items, size):
+    for i, chunk in enumerate(chunks(items, size)):
+        yield i * size, chunk
+
+
+class DeadLetterSpool(object):
+    """
+    Append-only file of actions or records that failed to be created or
+    sent, one json entry per line. Appends are safe across processes;
+    `claim` moves the current entries aside for a replay and `release`
+    puts back the ones that failed again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.replaying_path = path + ".replaying"
+        self._lock = threading.Lock()
+
+    def append(self, error, action=None, rec=None):
+        entry = {"failed": str(arrow.utcnow()), "error": error, "attempts": 1}
+        if action is not None:
+            entry["action"] = action
+        if rec is not None:
+            entry["rec"] = rec
+        self._write([entry])
+
+    def _write(self, entries):
+        with self._lock:
+            while True:
+                f = open(self.path, "a")
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    # the spool may have been claimed while waiting for
+                    # the lock; if so, append to the new one
+                    if (
+                        os.fstat(f.fileno()).st_ino
+                        == os.stat(self.path).st_ino
+                    ):
+                        for entry in entries:
+                            f.write(json.dumps(entry) + "\n")
+                        return
+                except FileNotFoundError:
+                    pass
+                finally:
+                    f.close()
+
+    def claim(self):
+        """
+        Returns the spooled entries and moves them aside until `release`.
+        Entries of an earlier replay that didn't finish are returned first.
+        """
+        if not os.path.exists(self.replaying_path):
+            try:
+                with open(self.path) as f:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                    os.replace(self.path, self.replaying_path)
+            except FileNotFoundError:
+                return []
+        else:
+            logger.warning(
+                "Resuming the unfinished replay of %s", self.replaying_path
+            )
+
+        with open(self.replaying_path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def release(self, remaining):
+        if remaining:
+            self._write(remaining)
+        os.remove(self.replaying_path)
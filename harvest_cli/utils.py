@@ -1,36 +1,197 @@
+import os
+import json
+import time
+import hashlib
 import logging
-from elasticsearch import Elasticsearch
+import threading
 from elasticsearch_dsl import Search, Q
+from elasticsearch_dsl.utils import AttrDict
+
+from .elastic import get_client, check_connection
 
 logger = logging.getLogger(__name__)
 
+EPISODE_INDEX = "episodes"
 
-def es_connection(es_host=None, **kwargs):
+_episode_cache = None
+# fields every cached episode list has; see `get_episodes_for_term`
+EPISODE_CACHE_FIELDS = ["mpid", "duration", "live_duration", "series"]
 
-    params = {"timeout": 30}
-    if es_host is not None:
-        params["hosts"] = [es_host]
+# paella events counted by the viewing_options export and the rollups
+PAELLA_EVENT_FILTERS = {
+    "view_mode": {
+        "term": {
+            "action.type": "paella:button:action;edu.harvard.dce.paella.viewModeTogglePlugin"
+        }
+    },
+    "playback_speed": {
+        "term": {
+            "action.type": "paella:button:action;es.upv.paella.playbackRatePlugin"
+        }
+    },
+    "captions": {"wildcard": {"action.type": "paella:caption:enabled*"}},
+}
 
-    params.update(kwargs)
 
-    es = Elasticsearch(**params)
+def es_connection(es_host=None, check=False, **kwargs):
+    """
+    Returns the shared client for `es_host`. With `check` the cluster is
+    contacted right away rather than on first use.
+    """
+    es = get_client(es_host, **kwargs)
+    if check:
+        check_connection(es)
+    return es
 
-    try:
-        es.info()
-    except Exception as ex:
-        logger.error("Connection to elasticsearch failed: %s", ex)
-        raise
 
-    return es
+def configure_episode_cache(cache_dir=None):
+    global _episode_cache
+    if cache_dir is None:
+        _episode_cache = None
+    else:
+        _episode_cache = EpisodeListCache(cache_dir)
 
 
 def get_episodes_for_term(es, term, year, fields=None):
-    s = Search(using=es, index="episodes")
+    """
+    Returns the term's episodes as `AttrDict`s with only `fields`, if
+    given. With an episode cache configured the term's episodes are cached
+    with at least `EPISODE_CACHE_FIELDS`, so callers asking for different
+    fields share one entry.
+    """
+    cache = _episode_cache
+    if cache is None:
+        return list(iter_episodes_for_term(es, term, year, fields))
+
+    # taken before the scan so changes made during it invalidate the entry
+    fingerprint = episode_index_fingerprint(es)
+    cached = cache.get(term, year, fingerprint)
+    if cached is not None and covers_fields(cached["fields"], fields):
+        logger.debug("episode cache hit for %s %s", term, year)
+        episodes = cached["episodes"]
+    else:
+        cache_fields = None
+        if fields is not None:
+            cache_fields = set(EPISODE_CACHE_FIELDS) | set(fields)
+            # keep whatever an earlier caller needed too
+            if cached is not None and cached["fields"] is not None:
+                cache_fields |= set(cached["fields"])
+            cache_fields = sorted(cache_fields)
+        episodes = [
+            x.to_dict()
+            for x in iter_episodes_for_term(es, term, year, cache_fields)
+        ]
+        cache.set(term, year, fingerprint, cache_fields, episodes)
+
+    if fields is not None:
+        episodes = [
+            dict((k, x[k]) for k in fields if k in x) for x in episodes
+        ]
+    return [AttrDict(x) for x in episodes]
+
+
+def iter_episodes_for_term(es, term, year, fields=None):
+    """
+    Streams the term's episodes from the episodes index as `AttrDict`s,
+    fetching only `fields` if given
+    """
+    s = Search(using=es, index=EPISODE_INDEX)
     s = s.filter(Q("term", term=term) & Q("term", year=year))
     if fields is not None:
         s = s.source(include=fields)
-    res = list(s.scan())
-    return res
+    for hit in s.scan():
+        yield AttrDict(hit.to_dict())
+
+
+# None stands for every field
+def covers_fields(cached_fields, fields):
+    if cached_fields is None:
+        return True
+    return fields is not None and set(fields) <= set(cached_fields)
+
+
+def episode_index_fingerprint(es):
+    """
+    Identifies the current contents of the episodes index: any document
+    indexed or deleted, or the index being recreated, changes it
+    """
+    stats = es.indices.stats(index=EPISODE_INDEX, metric=["docs", "indexing"])
+    settings = es.indices.get_settings(index=EPISODE_INDEX, name="index.uuid")
+    fingerprint = []
+    for name in sorted(stats["indices"]):
+        primaries = stats["indices"][name]["primaries"]
+        fingerprint.append(
+            [
+                name,
+                settings[name]["settings"]["index"]["uuid"],
+                primaries["docs"]["count"],
+                primaries["docs"]["deleted"],
+                primaries["indexing"]["index_total"],
+                primaries["indexing"]["delete_total"],
+            ]
+        )
+    return fingerprint
+
+
+class EpisodeListCache(object):
+    """
+    On-disk cache of term episode lists keyed by (term, year). An entry
+    is only used while the episodes index fingerprint it was saved with
+    still matches.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, term, year):
+        raw = json.dumps([term, year])
+        key = hashlib.sha1(raw.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def get(self, term, year, fingerprint):
+        """
+        Returns the entry, a dict with the cached "fields" (None for all)
+        and "episodes", or None if it's missing or stale
+        """
+        cached = read_json_file(self.path(term, year))
+        if cached is None or cached["fingerprint"] != fingerprint:
+            return None
+        return cached
+
+    def set(self, term, year, fingerprint, fields, episodes):
+        write_json_file(
+            self.path(term, year),
+            {
+                "fingerprint": fingerprint,
+                "fields": fields,
+                "episodes": episodes,
+            },
+        )
+
+
+def read_json_file(path):
+    """
+    Returns the decoded json in `path`, or None if there's no such file
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_json_file(path, data):
+    """
+    Writes `data` to `path` as json, creating its directory. The file is
+    written under a temporary name and renamed into place, so readers in
+    other threads or processes never see a partial file.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
 
 
 def get_series_for_term(es, term, year):
@@ -48,3 +209,77 @@ def get_mpids_from_useractions(es, index_pattern):
     if "aggregations" not in res:
         return []
     return [x["key"] for x in res.aggregations.mpids.buckets]
+
+
+def msearch(es, index, searches):
+    """
+    Sends a list of search bodies in a single msearch request and returns
+    the list of responses, in the same order
+    """
+    body = []
+    for search in searches:
+        body.append({"index": index})
+        body.append(search)
+    return es.msearch(body=body)["responses"]
+
+
+def heartbeat_span_buckets(es, index, mpids, interval, live=None):
+    """
+    Returns the `interval` second inpoint buckets watched in the playing
+    HEARTBEAT_SPAN records of `mpids`, written by `useractions
+    --coalesce-heartbeats`. Each span covers every bucket from its
+    `span.start_inpoint` to its `span.end_inpoint`. Returns a dict of
+    mpid to a dict of (huid, is_live) to a (set of bucket keys, heartbeat
+    count) pair.
+    """
+    s = Search(using=es, index=index)
+    s = s.filter(
+        Q("terms", mpid=list(mpids))
+        & Q("term", **{"action.type": "HEARTBEAT_SPAN"})
+        & Q("term", **{"action.is_playing": True})
+        & ~Q("term", huid="anonymous")
+    )
+    if live is not None:
+        s = s.filter(Q("term", is_live=int(live)))
+    s = s.source(include=["mpid", "huid", "is_live", "span"])
+
+    spans = {}
+    for hit in s.scan():
+        doc = hit.to_dict()
+        span = doc.get("span", {})
+        try:
+            start = int(span["start_inpoint"]) // interval * interval
+            end = int(span["end_inpoint"]) // interval * interval
+        except (KeyError, TypeError, ValueError):
+            continue
+        viewers = spans.setdefault(doc["mpid"], {})
+        key = (doc["huid"], int(doc["is_live"]))
+        buckets, count = viewers.get(key, (set(), 0))
+        buckets.update(range(start, max(start, end) + interval, interval))
+        viewers[key] = (buckets, count + span.get("count", 1))
+    return spans
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+class RateLimiter(object):
+    """
+    Enforces a minimum interval in seconds between calls to `wait`; safe to
+    share between threads
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._last = None
+
+    def wait(self):
+        with self._lock:
+            if self._last is not None:
+                remaining = self.interval - (time.time() - self._last)
+                if remaining > 0:
+                    time.sleep(remaining)
+            self._last = time.time()
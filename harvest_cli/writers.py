@@ -0,0 +1,146 @@
+import sys
+import click
+from csv import DictWriter
+
+FORMATS = ["csv", "parquet", "arrow"]
+
+# number of rows buffered per parquet row group / arrow record batch
+ROW_GROUP_SIZE = 50000
+
+
+def output_options(f):
+    """
+    Adds the --format/--output options shared by the export commands
+    """
+    f = click.option(
+        "-o",
+        "--output",
+        default="-",
+        help="file to write to; defaults to stdout (csv only)",
+    )(f)
+    f = click.option(
+        "--format",
+        "fmt",
+        type=click.Choice(FORMATS),
+        default="csv",
+        help="output format; parquet and arrow require pyarrow",
+    )(f)
+    return f
+
+
+def open_writer(fmt, output, columns, extrasaction="raise"):
+    """
+    Returns a writer with `writerow(row)` and `close()` methods.
+
+    `columns` is a list of (name, type) pairs. Types are only used by the
+    columnar formats: "category" columns are dictionary encoded, "string"
+    columns are plain strings and "int8"/"int16"/"int32"/"int64" are
+    integers.
+    """
+    fieldnames = [name for name, type_ in columns]
+    if fmt == "csv":
+        return CsvWriter(output, fieldnames, extrasaction)
+
+    if output == "-":
+        raise click.UsageError("--format %s requires an --output file" % fmt)
+    return ColumnarWriter(fmt, output, columns)
+
+
+class CsvWriter(object):
+    def __init__(self, output, fieldnames, extrasaction="raise"):
+        if output == "-":
+            self.f = sys.stdout
+        else:
+            self.f = open(output, "w", newline="")
+        self.writer = DictWriter(
+            self.f, fieldnames=fieldnames, extrasaction=extrasaction
+        )
+        self.writer.writeheader()
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+
+    def close(self):
+        if self.f is not sys.stdout:
+            self.f.close()
+
+
+class ColumnarWriter(object):
+    """
+    Buffers rows and writes them out as parquet row groups or as record
+    batches of an arrow ipc stream
+    """
+
+    def __init__(self, fmt, output, columns, row_group_size=ROW_GROUP_SIZE):
+        # only required for the columnar formats
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise click.ClickException(
+                "--format %s requires pyarrow; see optional-requirements.txt"
+                % fmt
+            )
+
+        self.pa = pa
+        self.fmt = fmt
+        self.columns = columns
+        self.row_group_size = row_group_size
+        self.buffer = dict((name, []) for name, type_ in columns)
+        self.buffered = 0
+        self.schema = pa.schema(
+            [pa.field(name, self.arrow_type(type_)) for name, type_ in columns]
+        )
+
+        if fmt == "parquet":
+            import pyarrow.parquet as pq
+
+            self.writer = pq.ParquetWriter(output, self.schema)
+        else:
+            # the stream format, unlike the file format, allows each batch
+            # to carry its own dictionaries
+            self.sink = pa.OSFile(output, "wb")
+            self.writer = pa.ipc.new_stream(self.sink, self.schema)
+
+    def arrow_type(self, type_):
+        if type_ == "category":
+            return self.pa.dictionary(self.pa.int32(), self.pa.string())
+        if type_ == "string":
+            return self.pa.string()
+        return getattr(self.pa, type_)()
+
+    def writerow(self, row):
+        for name, type_ in self.columns:
+            value = row.get(name)
+            if value is None:
+                pass
+            elif type_ in ("category", "string"):
+                value = str(value)
+            else:
+                value = int(value)
+            self.buffer[name].append(value)
+        self.buffered += 1
+        if self.buffered >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffered == 0:
+            return
+        arrays = []
+        for name, type_ in self.columns:
+            values = self.buffer[name]
+            if type_ == "category":
+                arrays.append(
+                    self.pa.array(values, self.pa.string()).dictionary_encode()
+                )
+            else:
+                arrays.append(self.pa.array(values, self.arrow_type(type_)))
+            self.buffer[name] = []
+        self.buffered = 0
+        table = self.pa.Table.from_arrays(arrays, schema=self.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        if self.fmt == "arrow":
+            self.sink.close()
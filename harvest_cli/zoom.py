@@ -1,22 +1,43 @@
 #!/usr/bin/env python
 
+import os
+import re
 import json
-import time
 import click
 import arrow
 import requests
+import threading
+import pytimeparse
+from contextlib import nullcontext
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import timedelta, datetime
-from elasticsearch.helpers import bulk as index_bulk
-from .geolocation import Geolocate
+from . import client
+from .geolocation import (
+    Geolocate,
+    open_geo_cache,
+    OPEN_MODES,
+    DEFAULT_CACHE_SIZE,
+    POOL_MIN_BATCH,
+)
 
-from .utils import es_connection
+from .setup import bulk_loading, BULK_MODE_STATE_FILE
+from .utils import es_connection, RateLimiter
 from harvest_cli import cli
+from .elastic import bulk_index
 
 import logging
 
 logger = logging.getLogger(__name__)
 
 API_BASE_URL = "https://api.zoom.us/v1"
+ACCOUNT_REPORT_MAX_DAYS = 30
+INDEX_PATTERNS = ["meetings-*", "sessions-*"]
+# meetings looked up in the index per mget request
+INDEXED_CHECK_BATCH_SIZE = 100
+# sessions of consecutive meetings are geolocated together, in batches big
+# enough for `--geo-processes` to kick in
+GEO_BATCH_SIZE = POOL_MIN_BATCH
 
 
 def yesterday(ctx, param, value):
@@ -32,6 +53,26 @@ def yesterday(ctx, param, value):
     callback=yesterday,
     help="fetch for date, e.g. YYYY-mm-dd; defaults to yesterday.",
 )
+@click.option(
+    "--from",
+    "from_date",
+    help="first date of a range to backfill, e.g. YYYY-mm-dd; overrides --date",
+)
+@click.option(
+    "--to",
+    "to_date",
+    help="last date (inclusive) of a range to backfill; defaults to --from",
+)
+@click.option(
+    "--workers",
+    default=1,
+    help="number of dates to harvest concurrently; defaults to 1",
+)
+@click.option(
+    "--resume-file",
+    help="file in which completed dates are recorded; "
+    "dates already listed there are skipped",
+)
 @click.option(
     "--destination",
     type=click.Choice(["index", "stdout"]),
@@ -59,51 +100,171 @@ def yesterday(ctx, param, value):
     envvar="GEOLITE_PATH",
     help="filepath to geolite database; defaults to $GEOLITE_PATH",
 )
-def zoom(date, destination, es_host, key, secret, geolite):
+@click.option(
+    "--geolite-mode",
+    envvar="GEOLITE_MODE",
+    type=click.Choice(OPEN_MODES),
+    default="auto",
+    help="how the geolite database is opened: memory-mapped or read "
+    "entirely into memory; defaults to $GEOLITE_MODE or 'auto'",
+)
+@click.option(
+    "--geolite-cache-size",
+    envvar="GEOLITE_CACHE_SIZE",
+    default=DEFAULT_CACHE_SIZE,
+    help="max number of networks kept in the geolocation lru cache",
+)
+@click.option(
+    "--geo-processes",
+    type=int,
+    help="resolve large batches of session ips with this many worker "
+    "processes; useful for backfills",
+)
+@click.option(
+    "--geo-cache",
+    envvar="GEO_CACHE",
+    help="persistent geolocation cache shared between runs; a redis url "
+    "or a sqlite file path; defaults to $GEO_CACHE",
+)
+@click.option(
+    "--bulk-mode",
+    is_flag=True,
+    help="disable refreshes and replicas on the meetings/sessions indices "
+    "while indexing; see `setup bulk-mode`",
+)
+@click.option(
+    "--bulk-mode-state-file",
+    envvar="BULK_MODE_STATE_FILE",
+    default=BULK_MODE_STATE_FILE,
+    help="state file of `setup bulk-mode`; if it exists bulk mode is "
+    "already on and is left on",
+)
+@click.option(
+    "--force",
+    is_flag=True,
+    help="fetch and re-index every meeting, including those already "
+    "completely indexed",
+)
+def zoom(
+    date,
+    from_date,
+    to_date,
+    workers,
+    resume_file,
+    destination,
+    es_host,
+    key,
+    secret,
+    geolite,
+    geolite_mode,
+    geolite_cache_size,
+    geo_processes,
+    geo_cache,
+    bulk_mode,
+    bulk_mode_state_file,
+    force,
+):
+
+    if from_date is not None:
+        dates = date_range(from_date, to_date or from_date)
+    else:
+        dates = [date]
 
+    if resume_file is not None:
+        completed = load_completed_dates(resume_file)
+        skipped = [d for d in dates if d in completed]
+        if skipped:
+            logger.info("Skipping %d already completed dates", len(skipped))
+        dates = [d for d in dates if d not in completed]
+
+    if len(dates) == 0:
+        logger.info("Nothing to harvest")
+        return
+
+    es = None
     if destination == "index":
         es = es_connection(es_host)
-        meetings_index = "meetings-" + date.replace("-", ".")
-        sessions_index = "sessions-" + date.replace("-", ".")
 
     try:
-        meeting_data = get_sessions_from(date, key, secret)
-        g = Geolocate(geolite)
+        # host and series info is shared by all dates in the range
+        host_ids = get_active_hosts(dates[0], dates[-1], key, secret)
+        series_info = get_series_info(host_ids, key, secret)
+        g = Geolocate(
+            geolite,
+            cache_size=geolite_cache_size,
+            mode=geolite_mode,
+            store=geo_cache and open_geo_cache(geo_cache) or None,
+            processes=geo_processes,
+        )
+
         count_meetings = 0
         count_sessions = 0
-
-        for meeting_doc, session_docs in meeting_data:
-
-            count_meetings += 1
-            count_sessions += len(session_docs)
-
-            for s in session_docs:
-                s["geoip"] = g.get(s["ip_address"])
-
-            if destination == "index":
-                es.index(
-                    index=meetings_index,
-                    doc_type="meeting",
-                    body=meeting_doc,
-                    id=meeting_doc["uuid"],
-                )
-                session_actions = [
-                    dict(
-                        _index=sessions_index,
-                        _type="session",
-                        _id=s["meeting"] + s["user_id"],
-                        **s
-                    )
-                    for s in session_docs
-                ]
-                index_bulk(es, session_actions)
-            else:
-                click.echo(json.dumps(meeting_doc))
-                for s in session_docs:
-                    click.echo(json.dumps(s))
+        count_skipped = 0
+        failed = []
+
+        loading = nullcontext()
+        if bulk_mode and es is not None:
+            loading = bulk_loading(
+                es, INDEX_PATTERNS, state_file=bulk_mode_state_file
+            )
+
+        with loading, ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(
+                    harvest_date,
+                    d,
+                    destination,
+                    es,
+                    g,
+                    key,
+                    secret,
+                    series_info,
+                    force,
+                ): d
+                for d in dates
+            }
+            try:
+                for future in as_completed(futures):
+                    d = futures[future]
+                    try:
+                        counts = future.result()
+                    except (
+                        OSError,
+                        requests.HTTPError,
+                        ZoomApiException,
+                        client.CacheMissError,
+                    ) as e:
+                        logger.error("Harvest of %s failed: %s", d, str(e))
+                        failed.append(d)
+                        continue
+                    except Exception:
+                        # e.g. an indexing error; the other dates go on
+                        logger.exception("Harvest of %s failed", d)
+                        failed.append(d)
+                        continue
+
+                    count_meetings += counts[0]
+                    count_sessions += counts[1]
+                    count_skipped += counts[2]
+                    if resume_file is not None:
+                        record_completed_date(resume_file, d)
+            except BaseException:
+                # don't start the queued dates; the executor still waits
+                # for the ones in progress
+                for future in futures:
+                    future.cancel()
+                raise
 
         logger.info("total zoom meetings: %d" % count_meetings)
         logger.info("total zoom sessions: %d" % count_sessions)
+        logger.info("total zoom meetings already indexed: %d" % count_skipped)
+        if failed:
+            logger.error("Failed dates: %s", ", ".join(sorted(failed)))
+        logger.info(
+            "geolocation cache: %(hits)d hits, %(store_hits)d persistent "
+            "cache hits, %(misses)d misses, "
+            "%(evictions)d evictions, %(hit_rate).2f hit rate" % g.stats()
+        )
         g.close()
 
     except OSError as e:
@@ -112,28 +273,194 @@ def zoom(date, destination, es_host, key, secret, geolite):
         logger.error("Error making API request: %s" % str(e))
     except ZoomApiException as e:
         logger.error("The API returned an error response: %s" % str(e))
+    except client.CacheMissError as e:
+        logger.error("Replay failed: %s" % str(e))
     except KeyboardInterrupt:
         logger.info("Quitting")
         raise click.Abort()
 
 
+def harvest_date(
+    date, destination, es, g, key, secret, series_info=None, force=False
+):
+
+    meetings_index = "meetings-" + date.replace("-", ".")
+    sessions_index = "sessions-" + date.replace("-", ".")
+
+    skipped = []
+
+    def skip(meeting_docs):
+        uuids = indexed_meetings(es, meetings_index, meeting_docs)
+        skipped.extend(uuids)
+        return uuids
+
+    meeting_data = get_sessions_from(
+        date,
+        key,
+        secret,
+        series_info,
+        skip=skip if destination == "index" and not force else None,
+    )
+    count_meetings = 0
+    count_sessions = 0
+    pending = []
+    pending_sessions = 0
+
+    for meeting_doc, session_docs in meeting_data:
+
+        count_meetings += 1
+        count_sessions += len(session_docs)
+
+        pending.append((meeting_doc, session_docs))
+        pending_sessions += len(session_docs)
+        if pending_sessions >= GEO_BATCH_SIZE:
+            write_meetings(
+                pending, destination, es, g, meetings_index, sessions_index
+            )
+            pending = []
+            pending_sessions = 0
+
+    write_meetings(pending, destination, es, g, meetings_index, sessions_index)
+
+    logger.info(
+        "%s: %d zoom meetings, %d zoom sessions, %d meetings already indexed",
+        date,
+        count_meetings,
+        count_sessions,
+        len(skipped),
+    )
+    return count_meetings, count_sessions, len(skipped)
+
+
+def write_meetings(
+    meeting_data, destination, es, g, meetings_index, sessions_index
+):
+    """
+    Geolocates the sessions of all of `meeting_data` as one batch, then
+    indexes or prints each meeting and its sessions
+    """
+    if not meeting_data:
+        return
+    session_docs = [s for _, docs in meeting_data for s in docs]
+    geoips = g.get_many([s["ip_address"] for s in session_docs])
+    for s, geoip in zip(session_docs, geoips):
+        s["geoip"] = geoip
+
+    for meeting_doc, session_docs in meeting_data:
+        if destination == "index":
+            session_actions = [
+                dict(
+                    _index=sessions_index,
+                    _type="session",
+                    _id=s["meeting"] + s["user_id"],
+                    **s
+                )
+                for s in session_docs
+            ]
+            bulk_index(es, session_actions)
+            # the meeting is indexed last so that an interrupted run leaves
+            # it missing, and refetched next time, rather than incomplete
+            meeting_doc["sessions_indexed"] = len(session_docs)
+            es.index(
+                index=meetings_index,
+                doc_type="meeting",
+                body=meeting_doc,
+                id=meeting_doc["uuid"],
+            )
+        else:
+            with _echo_lock:
+                click.echo(json.dumps(meeting_doc))
+                for s in session_docs:
+                    click.echo(json.dumps(s))
+
+
+def indexed_meetings(es, index, meeting_docs):
+    """
+    Returns the uuids of `meeting_docs` that are completely indexed in
+    `index`: their meeting doc records that its sessions were indexed and
+    has the same number of participant sessions as the new one
+    """
+    resp = es.mget(
+        index=index,
+        doc_type="meeting",
+        body={"ids": [m["uuid"] for m in meeting_docs]},
+        _source_include="sessions_indexed,participant_sessions",
+    )
+    participants = {m["uuid"]: m["participant_sessions"] for m in meeting_docs}
+    indexed = set()
+    for doc in resp["docs"]:
+        # a missing index is reported as an error per doc
+        if not doc.get("found"):
+            continue
+        source = doc["_source"]
+        if (
+            "sessions_indexed" in source
+            and source.get("participant_sessions") == participants[doc["_id"]]
+        ):
+            indexed.add(doc["_id"])
+    return indexed
+
+
+def date_range(from_date, to_date):
+    start = datetime.strptime(from_date, "%Y-%m-%d")
+    end = datetime.strptime(to_date, "%Y-%m-%d")
+    return [
+        (start + timedelta(days=i)).strftime("%Y-%m-%d")
+        for i in range((end - start).days + 1)
+    ]
+
+
+# resume state for backfills; one completed date per line
+def load_completed_dates(resume_file):
+    if not os.path.exists(resume_file):
+        return set()
+    with open(resume_file) as f:
+        return set(line.strip() for line in f if line.strip())
+
+
+def record_completed_date(resume_file, date):
+    with open(resume_file, "a") as f:
+        f.write(date + "\n")
+
+
 class ZoomApiException(Exception):
     pass
 
 
-def fetch_records(
+# api rate limits are per endpoint, so limiters are shared by every
+# thread fetching from the same url
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+_echo_lock = threading.Lock()
+
+
+def get_rate_limiter(report_url, wait):
+    with _rate_limiters_lock:
+        if report_url not in _rate_limiters:
+            _rate_limiters[report_url] = RateLimiter(wait)
+        return _rate_limiters[report_url]
+
+
+def iter_records(
     report_url, params, listkey, countkey="total_records", wait=1
 ):
+    # yields records as each page arrives; `wait` is the minimum time between
+    # requests to `report_url`, shared across threads and measured from the
+    # previous request so time the caller spends on a page counts toward it
     params = params.copy()
-    records = []
+    fetched = 0
+    rate_limiter = get_rate_limiter(report_url, wait)
     logger.debug("get %s" % report_url)
 
     while True:
         logger.debug("params %s" % str(params))
 
-        r = requests.post(url=API_BASE_URL + report_url, data=params)
-        r.raise_for_status()
-        response = r.json()
+        response = client.request_json(
+            "post",
+            API_BASE_URL + report_url,
+            data=params,
+            rate_limiter=rate_limiter,
+        )
 
         if "error" in response.keys():
             error_code = response["error"]["code"]
@@ -143,38 +470,53 @@ def fetch_records(
                     "Returned error %s: %s, Call: %s, Params: %s"
                     % (error_code, error_message, report_url, params)
                 )
-                break
+                return
             else:
                 raise ZoomApiException(response["error"])
 
-        records.extend([record for record in response[listkey]])
+        page = response[listkey]
+        fetched += len(page)
 
         logger.debug(
-            "Fetched %d of %d total records", len(records), response[countkey]
+            "Fetched %d of %d total records", fetched, response[countkey]
         )
-        if len(records) >= response[countkey]:
-            break
 
-        time.sleep(wait)
+        for record in page:
+            yield record
+
+        if fetched >= response[countkey] or len(page) == 0:
+            return
 
         params["page_number"] += 1
 
-    return records
 
+def fetch_records(
+    report_url, params, listkey, countkey="total_records", wait=1
+):
+    return list(iter_records(report_url, params, listkey, countkey, wait))
 
-def get_active_hosts(date, key, secret):
-    params = {
-        "from": date,
-        "to": date,
-        "api_key": key,
-        "api_secret": secret,
-        "page_size": 300,  # max page size
-        "page_number": 1,
-    }
 
-    hosts = fetch_records("/report/getaccountreport", params, "users")
+def get_active_hosts(from_date, to_date, key, secret):
+    active_host_ids = []
+    dates = date_range(from_date, to_date)
+
+    # the account report covers at most a month per request
+    for i in range(0, len(dates), ACCOUNT_REPORT_MAX_DAYS):
+        window = dates[i : i + ACCOUNT_REPORT_MAX_DAYS]
+        params = {
+            "from": window[0],
+            "to": window[-1],
+            "api_key": key,
+            "api_secret": secret,
+            "page_size": 300,  # max page size
+            "page_number": 1,
+        }
+
+        hosts = iter_records("/report/getaccountreport", params, "users")
 
-    active_host_ids = [host["user_id"] for host in hosts]
+        for host in hosts:
+            if host["user_id"] not in active_host_ids:
+                active_host_ids.append(host["user_id"])
 
     return active_host_ids
 
@@ -193,7 +535,7 @@ def get_series_info(host_ids, key, secret):
 
         params["host_id"] = host_id
 
-        series = fetch_records("/meeting/list", params, "meetings")
+        series = iter_records("/meeting/list", params, "meetings")
 
         for meeting in series:
             meeting_id = meeting["id"]
@@ -211,15 +553,14 @@ def get_series_info(host_ids, key, secret):
                 "topic": meeting["topic"],
             }
 
-        time.sleep(1)
-
     return series_info
 
 
-def get_meetings(date, key, secret):
+def get_meetings(date, key, secret, series_info=None):
 
-    host_ids = get_active_hosts(date, key, secret)
-    series_info = get_series_info(host_ids, key, secret)
+    if series_info is None:
+        host_ids = get_active_hosts(date, date, key, secret)
+        series_info = get_series_info(host_ids, key, secret)
 
     params = {
         "from": date,
@@ -231,7 +572,7 @@ def get_meetings(date, key, secret):
         "page_number": 1,
     }
 
-    meetings = fetch_records(
+    meetings = iter_records(
         "/metrics/meetings", params, "meetings", wait=60
     )  # 1 min rate limit
 
@@ -248,7 +589,12 @@ def get_meetings(date, key, secret):
         yield create_meeting_document(meeting, topic, host_id)
 
 
-def get_sessions_from(date, key, secret):
+def get_sessions_from(date, key, secret, series_info=None, skip=None):
+    """
+    Yields (meeting doc, session docs) for the meetings of `date`. If
+    given, `skip` is called with batches of meeting docs and returns the
+    uuids of those whose sessions shouldn't be fetched.
+    """
 
     url = "/metrics/meetingdetail"
 
@@ -260,11 +606,13 @@ def get_sessions_from(date, key, secret):
         "page_number": 1,
     }
 
-    for meeting_doc in get_meetings(date, key, secret):
+    for meeting_doc in skip_meetings(
+        get_meetings(date, key, secret, series_info), skip
+    ):
 
         uuid = meeting_doc["uuid"]
         params["meeting_id"] = uuid
-        sessions = fetch_records(
+        sessions = iter_records(
             url, params, "participants", countkey="participants_count"
         )
 
@@ -272,11 +620,24 @@ def get_sessions_from(date, key, secret):
             create_sessions_document(session, uuid) for session in sessions
         ]
 
-        time.sleep(1)
-
         yield meeting_doc, session_docs
 
 
+def skip_meetings(meeting_docs, skip=None):
+    if skip is None:
+        yield from meeting_docs
+        return
+    meeting_docs = iter(meeting_docs)
+    while True:
+        batch = list(islice(meeting_docs, INDEXED_CHECK_BATCH_SIZE))
+        if not batch:
+            return
+        skipped = skip(batch)
+        for meeting_doc in batch:
+            if meeting_doc["uuid"] not in skipped:
+                yield meeting_doc
+
+
 def create_meeting_document(meeting, topic, host_id):
 
     doc = {
@@ -309,9 +670,9 @@ def create_meeting_document(meeting, topic, host_id):
 def create_sessions_document(session, meeting_uuid):
 
     try:
-        join_time = arrow.get(session["join_time"])
-        leave_time = arrow.get(session["leave_time"])
-        duration = (leave_time - join_time).seconds
+        duration = session_duration(
+            session["join_time"], session["leave_time"]
+        )
     except Exception as e:
         logger.warning(
             "Failed duration calc for session '%s': %s", session["id"], str(e)
@@ -340,8 +701,48 @@ def create_sessions_document(session, meeting_uuid):
     return doc
 
 
+# zoom timestamps are almost always UTC in exactly this form
+_UTC_TIMESTAMP_RE = re.compile(
+    r"([0-9]{4})-([0-9]{2})-([0-9]{2})T([0-9]{2}):([0-9]{2}):([0-9]{2})Z\Z"
+)
+_DURATION_RE = re.compile(r"(?:([0-9]{1,2}):)?([0-9]{1,2}):([0-9]{1,2})\Z")
+
+
+# fast path for YYYY-MM-DDTHH:mm:ssZ; returns None for anything else
+def parse_utc_timestamp(value):
+    m = isinstance(value, str) and _UTC_TIMESTAMP_RE.match(value)
+    if not m:
+        return None
+    try:
+        return datetime(*map(int, m.groups()))
+    except ValueError:
+        return None
+
+
+def session_duration(join_time, leave_time):
+    join_dt = parse_utc_timestamp(join_time)
+    leave_dt = parse_utc_timestamp(leave_time)
+    if join_dt is None or leave_dt is None:
+        return _session_duration(join_time, leave_time)
+    return (leave_dt - join_dt).seconds
+
+
+def _session_duration(join_time, leave_time):
+    return (arrow.get(leave_time) - arrow.get(join_time)).seconds
+
+
 # convert duration from MM:SS or HH:MM:SS to seconds
 def to_seconds(duration):
+    m = isinstance(duration, str) and _DURATION_RE.match(duration)
+    if m:
+        hours, minutes, seconds = (int(x or 0) for x in m.groups())
+        # out of range values are left to the strptime/pytimeparse path
+        if hours < 24 and minutes < 60 and seconds < 60:
+            return hours * 3600 + minutes * 60 + seconds
+    return _to_seconds(duration)
+
+
+def _to_seconds(duration):
     try:
         try:
             dt = datetime.strptime(duration, "%H:%M:%S")
@@ -351,8 +752,6 @@ def to_seconds(duration):
 
         return int(delta.total_seconds())
     except ValueError:
-        import pytimeparse
-
         logger.warning(
             "Duration parsing failed on input '%s'; falling back to pytimeparse. ",
             duration,